@@ -206,6 +206,9 @@ def main(target=[1, 0, 0, 0]):
     # calculated b field if fudging mag data
     b_calc = [0, 0, 0]
 
+    # Initialize filter once so that its weights, EOMs and work arrays are reused every iteration
+    ukf_filter = UKFilter(createEOMS(), hfunc_batch, state, cov, q, r)
+
     # Infinite loop to run until you kill it
     i = 0
     while (i < 10000):
@@ -237,7 +240,7 @@ def main(target=[1, 0, 0, 0]):
         data[5] = angular_vel[2]
 
         # Run UKF
-        state, cov = UKF(state, cov, q, r, B_true, reaction_speeds, old_reaction_speeds, data)
+        state, cov = ukf_filter.step(B_true, reaction_speeds, old_reaction_speeds, data)
         
         # Visualize if you want
         game_visualize(np.array([state[:4]]), i) # not working on Pi 0, but working on  Pi 4
@@ -22,6 +22,7 @@ from ukf.PySOL.wmm import *
 from ukf.simulator import *
 from adc.adc_pd_controller_numpy import pd_controller
 from ukf.UKF_algorithm_1D import *
+from ukf.UKF_algorithm import UKFilter
 import time
 import signal
 from interface.mpu9250.happy_sensors import *
@@ -194,6 +195,9 @@ def main(target):
     print("STARTING TEST RUN.")
     print(line, "\n")
 
+    # Initialize filter once so that its weights, EOMs and work arrays are reused every iteration
+    ukf_filter = UKFilter(createEOMS(), hfunc_batch, state, cov, q, r, normalizeQuaternion=False)
+
     # Infinite loop to run until you kill it
     i = 0
     while (1):
@@ -219,7 +223,7 @@ def main(target):
         data[2] = angular_vel[2]
 
         # Run UKF
-        state, cov = UKF(state, cov, q, r, B_true, reaction_speeds, old_reaction_speeds, data)
+        state, cov = ukf_filter.step(B_true, reaction_speeds, old_reaction_speeds, data)
         print("*Current state: ({:.2f}, {:.2f})".format(state[0],state[1]))
 
         # convert our euler state to quaternion (and one in proper frame of reference of visualizer)
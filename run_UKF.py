@@ -36,6 +36,7 @@ import ukf.simulator as simulator
 from ukf.PySOL.sol_sim import *
 import ukf.PySOL.spacecraft as sp
 import ukf.PySOL.orb_tools as ot
+import ukf.PySOL.sim_cache as sim_cache
 # from ukf.PySOL import sol_sim
 # from ukf.PySOL import orb_tools as ot
 
@@ -69,20 +70,17 @@ def run_ukf_textfile(start, cov, r, q, filename):
     '''
     # startTime = 2022.321
     t0 = dt.datetime(2022, 3, 21, 0, 0, 0)
-    # sim = sol_sim.Simulation(TIME = t0, mag_deg= 12)
-    sim = Simulation(TIME = t0, mag_deg= 12)
 
     # how long we're simulating for
     duration = .02
     OE1 = ot.OE_array(f = 0, a = 6_800, e = 0.00068, i = 51, Om = 30, w = 30)
-    sim.create_sc(OE_array= OE1, verbose = True, color = 'green', name = 'Low-Earth Orbit')
-
 
     DT = dt.timedelta(hours = duration)
     # resolution = timestep. Must match with rest of ukf
-    sim.propogate(DT, resolution =  .1)
-    orb_laln = sim.scs[0].state_mat.LALN
-    orb_h = ot.calc_h(sim.scs[0].state_mat.R_ECEF)
+    # propogated once, then loaded from ukf/PySOL/sim_cache/ while the orbit is unchanged
+    orbit = sim_cache.cached_orbit(OE1, t0, DT, resolution = .1, mag_deg = 12)
+    orb_laln = orbit['LALN']
+    orb_h = orbit['h']
 
     # print(sim.scs[0].state_mat.R_ECEF.shape)
     print(len(orb_laln))
@@ -0,0 +1,234 @@
+"""
+    ephemeris.py - piecewise Chebyshev ephemerides, in the style of an SPK type 2 segment
+
+        A trajectory is split into equal-length segments and each position component is fit with a
+        Chebyshev series over its segment. Velocity is the derivative of the position series, so the
+        stored coefficients are all that is needed to evaluate a full state at any epoch. With equal
+        segments the segment of an epoch is found by one division, so evaluation is O(1) per epoch.
+
+        Segments are halved until every sample of the fitted trajectory is within the requested
+        position and velocity tolerances. Epochs are held to the microsecond, which is ~8 mm of motion in low Earth
+        orbit, so tolerances much below 1e-5 km cannot be met.
+
+"""
+
+import numpy as np
+import numpy.polynomial.chebyshev as cheb
+
+import PySOL.time_tools as tt
+
+
+class Chebyshev_Ephemeris():
+
+    def __init__(self, coefficients, t0, segment_length, duration, tol = None, vel_tol = None):
+        """
+            Chebyshev_Ephemeris - piecewise Chebyshev position coefficients of one trajectory
+
+                Args:
+                    coefficients (n_seg x 3 x deg + 1 array): Chebyshev coefficients of X, Y, Z [km] for every segment
+                    t0 (datetime or datetime64): UTC epoch of the start of the first segment
+                    segment_length (float): length of every segment [s]
+                    duration (float): seconds from t0 covered by the ephemeris
+                    tol (float): position tolerance the coefficients were fit to [km], if known
+                    vel_tol (float): velocity tolerance the coefficients were fit to [km/s], if known
+        """
+
+        self.coefficients = np.asarray(coefficients, dtype = np.double)
+        self.t0 = np.datetime64(t0, 'us')
+        self.segment_length = float(segment_length)
+        self.duration = float(duration)
+        self.tol = tol
+        self.vel_tol = vel_tol
+
+        # Derivative of every series with respect to time, d(tau)/dt = 2/segment_length
+        self.coefficients_dot = cheb.chebder(self.coefficients, axis = 2)*(2/self.segment_length)
+
+    @property
+    def n_segments(self):
+        return self.coefficients.shape[0]
+
+    @property
+    def degree(self):
+        return self.coefficients.shape[2] - 1
+
+    @classmethod
+    def fit(cls, times, states, tol = 1e-5, degree = 12, segment_length = None, vel_tol = None):
+        """
+            fit - fits a trajectory with the longest equal-length segments that meet tol and vel_tol
+
+                Args:
+                    times (list or array of datetimes, or datetime64 array): UTC time of every state
+                    states (N x 6 array): ECI states [km, km/s]
+                    tol (float): largest position error at any sample [km]
+                    degree (int): degree of the Chebyshev series of every segment
+                    segment_length (float): first segment length tried [s], defaults to the whole trajectory
+                    vel_tol (float): largest velocity error at any sample [km/s], defaults to tol per 100 s
+
+                Returns:
+                    ephemeris (Chebyshev_Ephemeris): fitted ephemeris
+        """
+
+        times64 = tt.to_datetime64(times)
+        t0 = times64[0]
+        t_sec = tt.seconds_since(times64, t0)
+        R = np.asarray(states, dtype = np.double)[:, :3]
+        V = np.asarray(states, dtype = np.double)[:, 3:6]
+
+        duration = t_sec[-1]
+        if duration <= 0:
+            raise ValueError('Ephemeris fit needs states at two or more increasing times, got a span of {} s'.format(duration))
+
+        if vel_tol is None:
+            vel_tol = tol/100
+        if segment_length is None:
+            segment_length = duration
+
+        while True:
+            n_seg = max(int(np.ceil(duration/segment_length - 1e-9)), 1)
+            idx, tau = cls.locate(t_sec, segment_length, n_seg)
+
+            # Every segment needs more samples than coefficients for the error check to mean anything
+            counts = np.bincount(idx, minlength = n_seg)
+            if np.min(counts) <= degree + 1:
+                raise Exception('Tolerance of {} km and {} km/s not reachable with degree {} at this sample rate'.format(tol, vel_tol, degree))
+
+            coefficients = np.empty((n_seg, 3, degree + 1))
+            error = 0
+            vel_error = 0
+            for seg in range(n_seg):
+                mask = idx == seg
+                coef = cheb.chebfit(tau[mask], R[mask], degree)
+                coefficients[seg] = coef.T
+                error = max(error, np.max(np.abs(cheb.chebval(tau[mask], coef) - R[mask].T)))
+
+                # Velocity is the derivative of the position series, d(tau)/dt = 2/segment_length
+                coef_dot = cheb.chebder(coef)*(2/segment_length)
+                vel_error = max(vel_error, np.max(np.abs(cheb.chebval(tau[mask], coef_dot) - V[mask].T)))
+
+            if error <= tol and vel_error <= vel_tol:
+                return cls(coefficients, t0, segment_length, duration, tol, vel_tol)
+
+            segment_length = segment_length/2
+
+    @staticmethod
+    def locate(t_sec, segment_length, n_seg):
+        """
+            locate - segment index and normalized time of every epoch
+
+                Args:
+                    t_sec (N array): seconds since t0
+                    segment_length (float): length of every segment [s]
+                    n_seg (int): number of segments
+
+                Returns:
+                    idx (N array): segment of every epoch, the last segment also holds the final epoch
+                    tau (N array): time within the segment, scaled to [-1, 1]
+        """
+
+        idx = np.clip(np.floor(t_sec/segment_length).astype(int), 0, n_seg - 1)
+        tau = 2*(t_sec - idx*segment_length)/segment_length - 1
+
+        return idx, tau
+
+    def seconds(self, times):
+        """
+            seconds - seconds since t0 of UTC times, checked against the span of the ephemeris
+
+                Args:
+                    times (list or array of datetimes, or datetime64 array): UTC times
+
+                Returns:
+                    t_sec (N array): seconds since t0
+        """
+
+        t_sec = tt.seconds_since(times, self.t0)
+        if np.any(t_sec < 0) or np.any(t_sec > self.duration + 1e-6):
+            raise ValueError('Times outside the ephemeris span of {} s from {}'.format(self.duration, self.t0))
+
+        return t_sec
+
+    def evaluate(self, t_sec):
+        """
+            evaluate - ECI states at seconds since t0
+
+                Args:
+                    t_sec (N array): seconds since t0, within [0, duration]
+
+                Returns:
+                    S (N x 6 array): ECI states [km, km/s]
+        """
+
+        idx, tau = self.locate(np.atleast_1d(np.asarray(t_sec, dtype = np.double)), self.segment_length, self.n_segments)
+
+        S = np.empty((tau.shape[0], 6))
+        S[:, :3] = self.clenshaw(self.coefficients[idx], tau)
+        S[:, 3:] = self.clenshaw(self.coefficients_dot[idx], tau)
+
+        return S
+
+    def state_at(self, times):
+        """
+            state_at - ECI states at UTC times
+
+                Args:
+                    times (datetime, list or array of datetimes, or datetime64 array): UTC times
+
+                Returns:
+                    S (N x 6 array): ECI states [km, km/s]
+        """
+
+        return self.evaluate(self.seconds(times))
+
+    @staticmethod
+    def clenshaw(coefficients, tau):
+        """
+            clenshaw - Chebyshev series with a different set of coefficients per epoch
+
+                Args:
+                    coefficients (N x 3 x K array): coefficients of every epoch
+                    tau (N array): normalized times in [-1, 1]
+
+                Returns:
+                    values (N x 3 array): series values
+        """
+
+        x = tau[:, np.newaxis]
+        b1 = np.zeros(coefficients.shape[:2])
+        b2 = np.zeros(coefficients.shape[:2])
+        for k in range(coefficients.shape[2] - 1, 0, -1):
+            b1, b2 = coefficients[:, :, k] + 2*x*b1 - b2, b1
+
+        return coefficients[:, :, 0] + x*b1 - b2
+
+    def save(self, group):
+        """
+            save - writes the ephemeris into an HDF5 group
+
+                Args:
+                    group (h5py Group): group to write the coefficients and attributes to
+        """
+
+        group.create_dataset(name = 'coefficients', data = self.coefficients)
+        group.attrs['t0'] = str(self.t0)
+        group.attrs['t0 JD'] = tt.datetime_to_jd(self.t0)[0]
+        group.attrs['segment_length'] = self.segment_length
+        group.attrs['duration'] = self.duration
+        if self.tol is not None:
+            group.attrs['tol'] = self.tol
+        if self.vel_tol is not None:
+            group.attrs['vel_tol'] = self.vel_tol
+
+    @classmethod
+    def load(cls, group):
+        """
+            load - reads an ephemeris written by save
+
+                Args:
+                    group (h5py Group): group holding the coefficients and attributes
+
+                Returns:
+                    ephemeris (Chebyshev_Ephemeris): stored ephemeris
+        """
+
+        return cls(group['coefficients'][()], np.datetime64(group.attrs['t0'], 'us'),
+            group.attrs['segment_length'], group.attrs['duration'], group.attrs.get('tol'), group.attrs.get('vel_tol'))
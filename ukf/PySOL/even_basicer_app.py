@@ -13,12 +13,11 @@ import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
 import csv
-import h5py
-import astropy.time as astro_time
 
 import time
 
 from wmm import WMM
+from sim_file import Sim_File
 
 countries = gpd.read_file(gpd.datasets.get_path("naturalearth_lowres"))
 
@@ -37,7 +36,7 @@ df_bar = pd.DataFrame({
 
 
 
-class OAT:
+class OAT(Sim_File):
 
     def __init__(self, fn, path = 'save_sim/', output_path = 'outputs/'):
 
@@ -49,26 +48,10 @@ class OAT:
         self.sim_path = path
         self.out_path = output_path
 
-        f = h5py.File(self.sim_path + fn, 'r')
         print('Loading ' + fn + '..')
 
-        self.dt = f.attrs['dt']
-
-        self.X = f['states']['ECI']['X']
-        self.Y = f['states']['ECI']['Y']
-        self.Z = f['states']['ECI']['Z']
-        self.LALN = f['states']['angular']['LALN']
-        self.H = f['states']['ECI']['H']
-        self.OE_ = f['states']['angular']['OE']
-
-        self.B = f['B']['B']
-        self.Bx = f['B']['Bx']
-        self.By = f['B']['By']
-        self.Bz = f['B']['Bz']
-
-        self.times_jd = astro_time.Time(f['times']['JD'], format = 'jd').jd
-
-        self.times_utc = astro_time.Time(f['times']['JD'], format = 'jd').datetime
+        # Frames are read from the file as they are indexed
+        Sim_File.__init__(self, self.sim_path + fn)
 
         print('data successfully loaded..')
 
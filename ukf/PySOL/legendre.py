@@ -9,8 +9,8 @@
 
     Last modified: 25 Oct 2022
 '''
+import functools
 import numpy as np
-from scipy.special import lpmn
 
 def lpmn_alt_not(n, x):
     ''' Function to switch between P_l^m notation and the P_l,m
@@ -26,6 +26,8 @@ def lpmn_alt_not(n, x):
         lpmv_alt_not (m+1, n+1), for all orders 0..m and degrees 0..n
     '''
 
+    from scipy.special import lpmn
+
     # Get (m+1, n+1) array (in this case m = n)
     lpmv_alt_not = lpmn(n, n, x)[0] # indexing 0th element to grab only polynomial, not derivative
     
@@ -39,13 +41,93 @@ def lpmn_alt_not(n, x):
 
     return lpmv_alt_not
 
+@functools.lru_cache(maxsize=None)
+def ssn_recursion_coefficients(n_max):
+    ''' Coefficients of the Schmidt semi-normalized recursion, computed once per maximum degree
+
+    For degree n and order m < n:
+        P_n,m = a_n,m * x * P_n-1,m - b_n,m * P_n-2,m
+    with a_n,m = (2n - 1) / sqrt(n^2 - m^2) and b_n,m = sqrt((n-1)^2 - m^2) / sqrt(n^2 - m^2), and on the diagonal:
+        P_n,n = c_n * z * P_n-1,n-1
+    with c_1 = 1 and c_n = sqrt((2n - 1) / 2n), where x = sin(latitude) and z = cos(latitude)
+
+    Args:
+        n_max (int): max degree the functions are calculated to
+
+    Return
+        a, b (np.array of size (n_max + 1)*(n_max + 2)/ 2): recursion coefficients, stored at index n * (n+1) / 2 + m
+        c (np.array of size n_max + 1): diagonal coefficients
+    '''
+
+    length = int((n_max + 1)*(n_max + 2) / 2)
+    a = np.zeros(length)
+    b = np.zeros(length)
+    c = np.ones(n_max + 1)
+
+    for n in range(1, n_max + 1):
+        if n > 1:
+            c[n] = np.sqrt((2*n - 1) / (2*n))
+        for m in range(n):
+            norm = np.sqrt(n**2 - m**2)
+            a[n*(n+1)//2 + m] = (2*n - 1) / norm
+            b[n*(n+1)//2 + m] = np.sqrt((n-1)**2 - m**2) / norm if n - 1 > m else 0.0
+
+    for array in (a, b, c):
+        array.flags.writeable = False
+
+    return a, b, c
+
+def ssn_legendre(n_max, x):
+    ''' Schmidt semi normalized Legendre functions and their derivatives with respect to latitude, generated by
+    recursion in degree for every element of x at once
+
+    See US/UK World Magnetic Model 2020-2025 | Technical Report
+
+    Args:
+        n_max (int): max degree the functions are calculated to
+        x (float or np.array of N elements): sin(latitude), argument of SSN Legendre function
+
+    Return
+        P (np.array of size ((n_max + 1)*(n_max + 2)/ 2, N)): where row n * (n+1) / 2 + m holds the Schmidt semi
+            normalized Legendre function of degree n and order m at every x
+        dP (np.array, same size as P): derivative of every function with respect to latitude
+    '''
+
+    a, b, c = ssn_recursion_coefficients(n_max)
+
+    x = np.array(x, dtype=float, ndmin=1)
+    z = np.sqrt(1 - x**2)
+
+    P = np.zeros((a.shape[0], x.shape[0]))
+    dP = np.zeros((a.shape[0], x.shape[0]))
+    P[0] = 1
+
+    for n in range(1, n_max + 1):
+        k = n*(n+1)//2
+        k1 = (n-1)*n//2
+        k2 = (n-2)*(n-1)//2
+
+        # Diagonal, from the previous diagonal
+        P[k + n] = c[n]*z*P[k1 + n - 1]
+        dP[k + n] = c[n]*(z*dP[k1 + n - 1] - x*P[k1 + n - 1])
+
+        # Orders below the diagonal, from the two previous degrees
+        for m in range(n):
+            P[k + m] = a[k + m]*x*P[k1 + m]
+            dP[k + m] = a[k + m]*(x*dP[k1 + m] + z*P[k1 + m])
+            if n - 1 > m:
+                P[k + m] -= b[k + m]*P[k2 + m]
+                dP[k + m] -= b[k + m]*dP[k2 + m]
+
+    return P, dP
+
 def ssn_lpmv(n_max, x):
     ''' Schmidt semi normalized Legendre function. Written to emulate's pyshtools PlmSchmidt() function to replace
 
     See US/UK World Magnetic Model 2020-2025 | Technical Report
 
     Args:
-        n_max: 
+        n_max: max degree the functions are calculated to
         x (float): argument of SSN Legendre function
 
     Return
@@ -53,16 +135,4 @@ def ssn_lpmv(n_max, x):
         Schmidt semi normalized Legendre of 
     '''
 
-    lpmv_alt_not_vals = lpmn_alt_not(n_max, x)
-
-    ssn_lpmv_vals = np.zeros(int((n_max + 1)*(n_max+2) / 2 ))
-
-    # Normalizing factor sqrt( 2 * (n - m)!/ (n+m)! )
-    for n_ite in np.arange(0, n_max + 1, 1):
-        for m_ite in np.arange(0, n_ite + 1, 1):
-            if m_ite == 0:
-                ssn_lpmv_vals[int(n_ite * (n_ite+1) / 2 + m_ite)] = lpmv_alt_not_vals[n_ite, m_ite]
-            if m_ite > 0:
-                ssn_lpmv_vals[int(n_ite * (n_ite+1) / 2 + m_ite)] = np.sqrt(2 *np.math.factorial(n_ite - m_ite)/np.math.factorial(n_ite + m_ite) ) * lpmv_alt_not_vals[n_ite, m_ite]
-    
-    return ssn_lpmv_vals
\ No newline at end of file
+    return ssn_legendre(n_max, x)[0][:, 0]
@@ -14,12 +14,11 @@ from jupyter_dash import JupyterDash
 import plotly.graph_objects as go
 
 import csv
-import h5py
-import astropy.time as astro_time
 
 import time
 
 from wmm import WMM
+from sim_file import Sim_File
 
 
 
@@ -35,7 +34,7 @@ from pyorbital.orbital import Orbital
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
 
-class OAT:
+class OAT(Sim_File):
 
     def __init__(self, fn, path = 'save_sim/', output_path = 'outputs/'):
 
@@ -47,26 +46,10 @@ class OAT:
         self.sim_path = path
         self.out_path = output_path
 
-        f = h5py.File(self.sim_path + fn, 'r')
         print('Loading ' + fn + '..')
 
-        self.dt = f.attrs['dt']
-
-        self.X = f['states']['ECI']['X']
-        self.Y = f['states']['ECI']['Y']
-        self.Z = f['states']['ECI']['Z']
-        self.LALN = f['states']['angular']['LALN']
-        self.H = f['states']['ECI']['H']
-        self.OE_ = f['states']['angular']['OE']
-
-        self.B = f['B']['B']
-        self.Bx = f['B']['Bx']
-        self.By = f['B']['By']
-        self.Bz = f['B']['Bz']
-
-        self.times_jd = astro_time.Time(f['times']['JD'], format = 'jd').jd
-
-        self.times_utc = astro_time.Time(f['times']['JD'], format = 'jd').datetime
+        # Frames are read from the file as they are indexed
+        Sim_File.__init__(self, self.sim_path + fn)
 
         print('data successfully loaded..')
 
@@ -23,6 +23,11 @@ class Orbital_Models:
             'Two-Body' : self.TBP_state_func
         }
 
+        # State functions for (N, 6) blocks of states
+        self.state_func_batch_dict = {
+            'Two-Body' : self.TBP_state_func_batch
+        }
+
         pass
 
     def get_state_func(self):
@@ -31,6 +36,12 @@ class Orbital_Models:
 
         return state_func
 
+    def get_state_func_batch(self):
+
+        state_func_batch = self.state_func_batch_dict[self.md_nm]
+
+        return state_func_batch
+
     def TBP_state_func(self, t, S):
         """
             state_func - Runge Kutta integration function
@@ -62,6 +73,30 @@ class Orbital_Models:
 
         return Sdot
 
+    def TBP_state_func_batch(self, t, S):
+        """
+            TBP_state_func_batch - TBP_state_func for many spacecraft at once
+
+            Arguments:
+                t (float) : time (seconds)
+                S (Nx6 array) : state vectors (ECI), one row per spacecraft
+                                [x, y, z, dx, dy, dz] in km and km/s
+
+            Returns:
+                Sdot (Nx6 array) : state derivatives
+        """
+
+        mu_E = self.mu_earth
+
+        r_ = S[:, 0:3]
+        r = np.linalg.norm(r_, axis = 1)[:, np.newaxis]
+
+        Sdot = np.empty_like(S)
+        Sdot[:, 0:3] = S[:, 3:6]
+        Sdot[:, 3:6] = -(mu_E/r**3)*r_
+
+        return Sdot
+
 
 
         
@@ -12,16 +12,68 @@ import numpy as np
 
 import PySOL.orb_tools as ot
 import PySOL.constants as constants
+import PySOL.time_tools as tt
 import datetime as dt
 
 import astropy.time as astro_time
 
 
+class Growable_Array():
+    """
+        Growable_Array - array that grows along its first axis by doubling its 
+            capacity whenever it is full, so appending N rows in chunks costs O(N)
+            copying overall. data is a view of the filled rows only
+    
+    """
+
+    def __init__(self, rows, dtype = np.double, copy = True):
+        """
+            __init__ - starts the array with rows (M x ...), copying them unless copy is False
+        
+        """
+
+        self.buffer = np.array(rows, dtype = dtype) if copy else np.asarray(rows, dtype = dtype)
+        self.size = len(self.buffer)
+
+    def __len__(self):
+
+        return self.size
+
+    @property
+    def data(self):
+
+        return self.buffer[:self.size]
+
+    def append(self, rows):
+        """
+            append - adds rows (K x ...) to the end of the array, reallocating
+                at twice the capacity when they do not fit
+        
+        """
+
+        rows = np.asarray(rows, dtype = self.buffer.dtype)
+        needed = self.size + len(rows)
+
+        if needed > len(self.buffer):
+            capacity = max(needed, 2*len(self.buffer), 16)
+            buffer = np.empty((capacity,) + self.buffer.shape[1:], dtype = self.buffer.dtype)
+            buffer[:self.size] = self.buffer[:self.size]
+            self.buffer = buffer
+
+        self.buffer[self.size:needed] = rows
+        self.size = needed
+
+
 class State_Matrix():
     """
         state_matrix - state matrix holds the states of a spacecraft object
             in all reference frames. States are natively held in ECI and UTC 
             coordinates but can be expressed in any defined frame 
+
+            ECI states are kept in a single growable (N, 6) array, S_, which the per
+            axis attributes (R_, V_, X, Y, Z, VX, VY, VZ) are views of. Other frames are
+            only calculated the first time they are accessed, then cached and extended
+            over newly appended rows
     
     """
 
@@ -35,94 +87,71 @@ class State_Matrix():
         self.Re = constants.R_E()
 
         # Set vector ECI frame attrs
-        self.S_ = STATES
-        self.R_ = STATES[:, 0:3]
-        self.V_ = STATES[:, 3:]
-
-        R = np.linalg.norm(self.R_)
-        self.R = np.array([R])
-        self.V = np.array([np.linalg.norm(self.V_)])
-        
-        self.H = np.array([R - self.Re])
-
-        # Set component ECI frame attrs
-        self.X =  STATES[:, 0]
-        self.Y =  STATES[:, 1]
-        self.Z =  STATES[:, 2]
-        self.VX = STATES[:, 3] 
-        self.VY = STATES[:, 4] 
-        self.VZ = STATES[:, 5] 
+        self.states = Growable_Array(STATES)
 
         # Set UTC times
-        self.times = np.array(TIMES)
-        self.times_jd = np.array(astro_time.Time(TIMES).jd)
-
-        # Setting non-ECI frame attrs
-        self.OE_ = np.zeros((len(self.S_), 6))
-        self.RADEC = np.zeros((len(self.S_), 2))
-        self.LALN = np.zeros((len(self.S_), 2))
-        self.R_ECEF = np.zeros((len(self.S_), 3))
-        for i, S_ in enumerate(self.S_):
-            self.OE_[i, :] = ot.calc_RV2OE(S_, verbose = False)
-            self.RADEC[i, :] = ot.calc_R2RADEC(self.R_[i], verbose = False)
-            self.LALN[i, :] = ot.calc_LALN(self.R_[i], self.times[i])
-            self.R_ECEF[i, :] = ot.calc_ECEF(self.R_[i], self.times[i])
+        self.utc = Growable_Array(TIMES, dtype = object)
+        self.jd = Growable_Array(tt.datetime_to_jd(TIMES), copy = False)
 
+        # Derived frames, filled in on first access
+        self.frames = {}
 
-    def append_states(self, new_STATES, new_TIMES):
+    def derived(self, name, func):
+        """
+            derived - returns a cached derived frame, calculating it with func(start, stop)
+                for the rows that have been appended since it was last accessed
+        """
 
-        self.S_ = np.concatenate((self.S_, new_STATES))
-
-        self.R_ = np.concatenate((self.R_, new_STATES[:, 0:3]))
-        self.V_ = np.concatenate((self.V_, new_STATES[:, 3:6]))
-
-        R = np.linalg.norm(new_STATES[:, 0:3], axis = 1)
-        V = np.linalg.norm(new_STATES[:, 3:6], axis = 1)
-        new_H = R - self.Re
-        self.R = np.concatenate((self.R, R))
-        self.V = np.concatenate((self.V, V))
-
-        self.H = np.concatenate((self.H, new_H))
-        # Set component ECI frame attrs
-        self.X =  np.concatenate((self.X, new_STATES[:, 0]))
-        self.Y =  np.concatenate((self.Y, new_STATES[:, 1]))
-        self.Z =  np.concatenate((self.Z, new_STATES[:, 2]))
-        self.VX = np.concatenate((self.VX, new_STATES[:, 3])) 
-        self.VY = np.concatenate((self.VY, new_STATES[:, 4]))
-        self.VZ = np.concatenate((self.VZ, new_STATES[:, 5]))
-
-        # Setting non-ECI frame attrs
-        new_OE = np.zeros((len(new_STATES), 6))
-        new_RADEC = np.zeros((len(new_STATES), 2))
-        new_LALN = np.zeros((len(new_STATES), 2))
-        new_R_ECEF = np.zeros((len(new_STATES), 3))
-        for i, S_ in enumerate(new_STATES):
-            new_OE[i, :] = ot.calc_RV2OE(S_, verbose = False)
-            new_RADEC[i, :] = ot.calc_R2RADEC(S_[0:3], verbose = False)
-            
-            new_LALN[i, :] = ot.calc_LALN(self.R_[i], new_TIMES[i])
-            new_R_ECEF[i, :] = ot.calc_ECEF(self.R_[i], new_TIMES[i])
+        rows = len(self.states)
+
+        if name not in self.frames:
+            self.frames[name] = Growable_Array(func(0, rows), copy = False)
+        elif len(self.frames[name]) < rows:
+            self.frames[name].append(func(len(self.frames[name]), rows))
+
+        return self.frames[name].data
+
+    # Trimmed views of the state and time buffers
+    S_ = property(lambda self: self.states.data)
+    times = property(lambda self: self.utc.data)
+    times_jd = property(lambda self: self.jd.data)
+
+    # Views of the ECI state array
+    R_ = property(lambda self: self.S_[:, 0:3])
+    V_ = property(lambda self: self.S_[:, 3:6])
+    X = property(lambda self: self.S_[:, 0])
+    Y = property(lambda self: self.S_[:, 1])
+    Z = property(lambda self: self.S_[:, 2])
+    VX = property(lambda self: self.S_[:, 3])
+    VY = property(lambda self: self.S_[:, 4])
+    VZ = property(lambda self: self.S_[:, 5])
+
+    # Derived frames
+    R = property(lambda self: self.derived('R', lambda i, j: np.linalg.norm(self.R_[i:j], axis = 1)))
+    V = property(lambda self: self.derived('V', lambda i, j: np.linalg.norm(self.V_[i:j], axis = 1)))
+    H = property(lambda self: self.derived('H', lambda i, j: self.R[i:j] - self.Re))
+    OE_ = property(lambda self: self.derived('OE_', lambda i, j: ot.calc_RV2OE_batch(self.S_[i:j])))
+    RADEC = property(lambda self: self.derived('RADEC', lambda i, j: ot.calc_R2RADEC_batch(self.R_[i:j])))
+    LALN = property(lambda self: self.derived('LALN', lambda i, j: ot.calc_LALN_batch(self.R_[i:j], self.times_jd[i:j])))
+    R_ECEF = property(lambda self: self.derived('R_ECEF', lambda i, j: ot.calc_ECEF_batch(self.R_[i:j], self.times_jd[i:j])))
 
-            # print('RADEC', new_RADEC[i, :])
-            # print('LALN', new_LALN[i, :])
-            # print('Time', new_TIMES[i])
-            # print()
+    def append_states(self, new_STATES, new_TIMES):
+        """
+            append_states - adds new ECI states. Their UTC times are added by
+                append_times, which is called with the same new_TIMES
+        """
 
-        self.RADEC = np.concatenate((self.RADEC, new_RADEC))
-        self.OE_ = np.concatenate((self.OE_, new_OE))
-        self.RADEC = np.concatenate((self.RADEC, new_RADEC))
-        self.LALN = np.concatenate((self.LALN, new_LALN))
-        self.R_ECEF = np.concatenate((self.R_ECEF, new_R_ECEF))
+        self.states.append(new_STATES)
 
     def append_times(self, new_TIMES):
 
         # Set UTC times
-        self.times = np.concatenate((self.times, new_TIMES))
-        self.times_jd = np.concatenate((self.times_jd, astro_time.Time(new_TIMES).jd))
+        self.utc.append(new_TIMES)
+        self.jd.append(tt.datetime_to_jd(new_TIMES))
 
     def to_OE(self, verbose = False):
 
-        return self.OE
+        return self.OE_
     
     def to_RADEC(self, verbose = False):
 
@@ -283,6 +312,162 @@ def calc_RV2OE(S, verbose = False):
 
     return OE_array
 
+def calc_RV2OE_batch(S):
+    """
+        calc_RV2OE_batch - calc_RV2OE for every row of a state array at once
+
+            Args:
+                S (Nx6 array): state vectors [km]/[km/s]
+                    x, y, z, vx, vy, vz in ECI frame
+
+            Returns:
+                OE_arrays (Nx6 array) - solved orbital elements of every state
+                    note: all angle quants in deg
+                    [f, a, e, i, Om, w]
+    """
+
+    mu_earth = constants.mu_Earth()
+
+    r_ = S[:, 0:3]
+    v_ = S[:, 3:6]
+    r = np.linalg.norm(r_, axis = 1)
+    vr = np.sum(v_*r_, axis = 1)/r
+
+    # Angular momentum
+    h_ = np.cross(r_, v_)
+    h = np.linalg.norm(h_, axis = 1)
+
+    # Node line, K x h_
+    N_ = np.column_stack((-h_[:, 1], h_[:, 0], np.zeros(len(S))))
+    N = np.linalg.norm(N_, axis = 1)
+
+    # Eccentricity
+    e_ = 1/mu_earth*np.cross(v_, h_) - r_/r[:, np.newaxis]
+    e = np.linalg.norm(e_, axis = 1)
+
+    a = h**2/(mu_earth*(1-e**2))
+    i = np.arccos(h_[:, 2]/h)
+
+    # Quadrant checks of calc_RV2OE
+    Om = np.arccos(N_[:, 0]/N)
+    Om = np.where(N_[:, 1] >= 0, Om, 2*np.pi - Om)
+
+    w = np.arccos(np.sum(N_*e_, axis = 1)/(N*e))
+    w = np.where(e_[:, 2] >= 0, w, 2*np.pi - w)
+
+    f = np.arccos(np.sum(e_*r_, axis = 1)/(e*r))
+    f = np.where(vr >= 0, f, 2*np.pi - f)
+
+    return np.column_stack((np.rad2deg(f), a, e, np.rad2deg(i), np.rad2deg(Om), np.rad2deg(w)))
+
+def calc_stumpff(z):
+    """
+        calc_stumpff - Stumpff functions C(z) and S(z) of the universal variable
+            formulation (Curtis eq 3.52-3.53), elementwise over an array
+
+            Args:
+                z (array): alpha*chi^2 values
+
+            Returns:
+                C, S (arrays): Stumpff functions at every z
+    """
+
+    z = np.asarray(z, dtype = np.double)
+    C = np.empty_like(z)
+    S = np.empty_like(z)
+
+    pos = z > 1e-8
+    neg = z < -1e-8
+    zero = ~(pos | neg)
+
+    sz = np.sqrt(z[pos])
+    C[pos] = (1 - np.cos(sz))/z[pos]
+    S[pos] = (sz - np.sin(sz))/sz**3
+
+    sz = np.sqrt(-z[neg])
+    C[neg] = (np.cosh(sz) - 1)/(-z[neg])
+    S[neg] = (np.sinh(sz) - sz)/sz**3
+
+    # Series around z = 0
+    C[zero] = 1/2 - z[zero]/24
+    S[zero] = 1/6 - z[zero]/120
+
+    return C, S
+
+def calc_kepler(S0, times, tol = 1e-12, max_iter = 50):
+    """
+        calc_kepler - analytic two-body propagation of many states to many times at once,
+            using the universal variable formulation with Lagrange coefficients (Curtis
+            Algorithms 3.3 and 3.4). Kepler's equation is solved by Newton's method for
+            every state and time together
+
+            Args:
+                S0 (Nx6 array): initial ECI states [km]/[km/s]
+                times (T array): times since the initial states in seconds
+
+            Opt Args:
+                tol (float): convergence tolerance of the universal anomaly
+                max_iter (int): most Newton iterations, states not converged by then raise an Exception naming them
+
+            Returns:
+                S (TxNx6 array): ECI states of every sc at every time
+    """
+
+    mu = constants.mu_Earth()
+    sqrt_mu = np.sqrt(mu)
+
+    S0 = np.atleast_2d(np.asarray(S0, dtype = np.double))
+    dt = np.asarray(times, dtype = np.double)[:, np.newaxis]
+
+    r0_ = S0[:, 0:3]
+    v0_ = S0[:, 3:6]
+    r0 = np.linalg.norm(r0_, axis = 1)
+    v0 = np.linalg.norm(v0_, axis = 1)
+    vr0 = np.sum(r0_*v0_, axis = 1)/r0
+
+    # Reciprocal of the semimajor axis
+    alpha = 2/r0 - v0**2/mu
+
+    # Newton iterations on the universal Kepler equation, (T, N) at once
+    chi = sqrt_mu*np.abs(alpha)*dt
+    converged = np.zeros(chi.shape, dtype = bool)
+    for i in range(max_iter):
+        z = alpha*chi**2
+        C, S = calc_stumpff(z)
+
+        F = r0*vr0/sqrt_mu*chi**2*C + (1 - alpha*r0)*chi**3*S + r0*chi - sqrt_mu*dt
+        dFdchi = r0*vr0/sqrt_mu*chi*(1 - z*S) + (1 - alpha*r0)*chi**2*C + r0
+
+        ratio = F/dFdchi
+        chi = chi - ratio
+
+        converged = np.abs(ratio) <= tol*np.maximum(1, np.abs(chi))
+        if np.all(converged):
+            break
+    else:
+        # Never return states from an unconverged universal anomaly
+        t_idx, sc_idx = np.nonzero(~converged)
+        failed = ', '.join('t = {} s of sc {}'.format(dt[t, 0], sc) for t, sc in zip(t_idx[:10], sc_idx[:10]))
+        raise Exception('Kepler propogation did not converge in {} iterations for {} states: {}{}'.format(
+            max_iter, t_idx.size, failed, ', ...' if t_idx.size > 10 else ''))
+
+    z = alpha*chi**2
+    C, S = calc_stumpff(z)
+
+    # Lagrange coefficients
+    f = 1 - chi**2/r0*C
+    g = dt - chi**3*S/sqrt_mu
+
+    r_ = f[:, :, np.newaxis]*r0_ + g[:, :, np.newaxis]*v0_
+    r = np.linalg.norm(r_, axis = 2)
+
+    fdot = sqrt_mu/(r*r0)*(z*chi*S - chi)
+    gdot = 1 - chi**2/r*C
+
+    v_ = fdot[:, :, np.newaxis]*r0_ + gdot[:, :, np.newaxis]*v0_
+
+    return np.concatenate((r_, v_), axis = 2)
+
 def calc_OE2RV(OE_array, verbose = False):
     """
         calc_OE2V - function takes in orbital element array
@@ -395,6 +580,27 @@ def calc_R2RADEC(r_, verbose):
     return RA_deg, Dec_deg 
 
 
+def calc_R2RADEC_batch(R):
+    """
+        calc_R2RADEC_batch - calc_R2RADEC for every row of a position array at once
+
+            Args:
+                R (Nx3 array) : position vectors in IJK ECI frame
+
+            Return:
+                RADEC (Nx2 array) : right ascension and declination of every position in degrees
+    """
+
+    r = np.linalg.norm(R, axis = 1)
+
+    Dec = np.arcsin(R[:, 2]/r)
+
+    RA = np.arccos(R[:, 0]/r/np.cos(Dec))
+    RA = np.where(R[:, 1]/r > 0, RA, 2*np.pi - RA)
+
+    return np.column_stack((np.rad2deg(RA), np.rad2deg(Dec)))
+
+
 def calc_th_0(time):
     """
     
@@ -429,6 +635,19 @@ def calc_th_0(time):
 
     return th_G_deg
 
+def calc_th_0_batch(JD):
+    """
+        calc_th_0_batch - calc_th_0 for an array of UTC Julian dates, see time_tools.calc_gmst
+
+            Args:
+                JD (N array) : UTC Julian dates
+
+            Return:
+                th_G_deg (N array) : Greenwich sidereal angle of every date in degrees
+    """
+
+    return tt.calc_gmst(JD)
+
 def calc_LALN(r_, time):
     """
     
@@ -446,6 +665,26 @@ def calc_LALN(r_, time):
 
     return LA, LN
 
+def calc_LALN_batch(R, JD):
+    """
+        calc_LALN_batch - calc_LALN for every row of a position array at once
+
+            Args:
+                R (Nx3 array) : position vectors in IJK ECI frame
+                JD (N array) : UTC Julian dates of the positions
+
+            Return:
+                LALN (Nx2 array) : latitude and longitude of every position in degrees
+    """
+
+    RADEC = calc_R2RADEC_batch(R)
+
+    LA = RADEC[:, 1]
+    LN = RADEC[:, 0] - calc_th_0_batch(JD)
+    LN = np.where(LN < -180, LN + 360, LN)
+
+    return np.column_stack((LA, LN))
+
 def calc_h(r_):
     """
     
@@ -477,6 +716,29 @@ def calc_ECEF(r_, time):
 
 
 
+def calc_ECEF_batch(R, JD):
+    """
+        calc_ECEF_batch - calc_ECEF for every row of a position array at once
+
+            Args:
+                R (Nx3 array) : position vectors in IJK ECI frame
+                JD (N array) : UTC Julian dates of the positions
+
+            Return:
+                R_ECEF (Nx3 array) : positions in the ECEF frame
+    """
+
+    LALN = np.deg2rad(calc_LALN_batch(R, JD))
+    r = np.linalg.norm(R, axis = 1)
+
+    LA_rad = LALN[:, 0]
+    LN_rad = LALN[:, 1]
+
+    return r[:, np.newaxis]*np.column_stack((np.cos(LA_rad)*np.cos(LN_rad), np.cos(LA_rad)*np.sin(LN_rad), np.sin(LA_rad)))
+
+
+
+
 def Rotate_Z(psi):
     """
         Rotate_Z - rotation matrix about the Z axis
@@ -0,0 +1,131 @@
+"""
+    sim_cache.py - on-disk cache of propogated orbits for scripts that rerun the same orbit
+
+        Orbits are stored by a hash of everything that determines them: orbital elements, epoch,
+        duration, resolution, dynamical model, integrator settings, WMM degree and coefficients,
+        so a file is only ever reused for an identical propogation. Changing any of them, or
+        CACHE_VERSION, gives a new key. Cache files are only replaced on refresh and can be deleted freely.
+
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import PySOL.orb_tools as ot
+import PySOL.wmm as wmm
+
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(MODULE_DIR, 'sim_cache')
+
+# Bump whenever the propogation or the cached quantities change
+CACHE_VERSION = 1
+
+
+def orbit_key(OE, t0, DT, resolution = 10, model_name = 'Two-Body', mag_deg = 12,
+    integrator = 'RK45', tol = [1e-7, 1e-4], coef_file = 'WMMcoef.csv'):
+    """
+        orbit_key - content hash of an orbit propogation
+
+            Args:
+                OE (OE_array or 1x6 array): initial orbital elements [f, a, e, i, Om, w]
+                t0 (datetime.datetime): UTC epoch
+                DT (datetime.timedelta): time of integration
+                resolution, integrator, tol: as in Simulation.propogate
+                model_name, mag_deg: as in Simulation
+                coef_file (str): WMM coefficient file
+
+            Returns:
+                key (str): hex digest naming the cache file
+    """
+
+    OE_ = OE.get_OE() if isinstance(OE, ot.OE_array) else np.asarray(OE, dtype = np.double)
+
+    settings = {
+        'version': CACHE_VERSION,
+        'OE': [float(x) for x in OE_],
+        't0': t0.isoformat(),
+        'DT': DT.total_seconds(),
+        'resolution': float(resolution),
+        'model_name': model_name,
+        'mag_deg': int(mag_deg),
+        'integrator': integrator,
+        'tol': [float(x) for x in tol],
+    }
+
+    digest = hashlib.sha256(json.dumps(settings, sort_keys = True).encode())
+    digest.update(wmm.load_coefficients(coef_file).tobytes())
+
+    return digest.hexdigest()
+
+def propogate_orbit(OE, t0, DT, resolution = 10, model_name = 'Two-Body', mag_deg = 12,
+    integrator = 'RK45', tol = [1e-7, 1e-4]):
+    """
+        propogate_orbit - propogates one sc and calculates the quantities kept by the cache
+
+            Args:
+                as orbit_key
+
+            Returns:
+                orbit (dict): times_jd (N), S_ (Nx6) ECI states, LALN (Nx2) [deg],
+                    h (N) height [km] and B (Nx3) magnetic field [nT]
+    """
+
+    # Imported here so that loading a cached orbit does not pay for the simulation imports
+    import PySOL.sol_sim as ss
+
+    if not isinstance(OE, ot.OE_array):
+        OE = ot.OE_array(*OE)
+
+    sim = ss.Simulation(model_name = model_name, mag_deg = mag_deg, TIME = t0)
+    sim.create_sc(OE_array = OE)
+    sim.propogate(DT, resolution = resolution, tol = tol, integrator = integrator)
+    sim.calc_B()
+
+    ST_MT = sim.scs[0].state_mat
+
+    return {
+        'times_jd': ST_MT.times_jd,
+        'S_': ST_MT.S_,
+        'LALN': ST_MT.LALN,
+        'h': ot.calc_h(ST_MT.R_ECEF),
+        'B': np.asarray(sim.scs[0].B_, dtype = np.double).T,
+    }
+
+def cached_orbit(OE, t0, DT, resolution = 10, model_name = 'Two-Body', mag_deg = 12,
+    integrator = 'RK45', tol = [1e-7, 1e-4], cache_dir = CACHE_DIR, refresh = False):
+    """
+        cached_orbit - propogate_orbit, loaded from cache_dir when the same orbit was propogated before
+
+            Args:
+                as orbit_key
+                cache_dir (str): directory of the cache files
+                refresh (bool): propogate again and overwrite the cached orbit
+
+            Returns:
+                orbit (dict): as propogate_orbit
+    """
+
+    settings = dict(resolution = resolution, model_name = model_name, mag_deg = mag_deg,
+        integrator = integrator, tol = tol)
+
+    path = os.path.join(cache_dir, orbit_key(OE, t0, DT, **settings) + '.npz')
+
+    if os.path.exists(path) and not refresh:
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+
+    orbit = propogate_orbit(OE, t0, DT, **settings)
+
+    # Write through a temporary file so that other processes never load a partial orbit
+    try:
+        os.makedirs(cache_dir, exist_ok = True)
+        temp_path = '{}.{}.tmp.npz'.format(os.path.splitext(path)[0], os.getpid())
+        np.savez(temp_path, **orbit)
+        os.replace(temp_path, path)
+    except OSError:
+        pass
+
+    return orbit
@@ -0,0 +1,315 @@
+"""
+    sim_file.py - layout of saved simulation files and a lazy reader for them
+
+        Layout version 2, written by Simulation.save_sim and Simulation.propogate_to_file:
+
+            attrs   : version, epoch (UTC of the first state), t0, tf, dt, N Sc, Dyn Model
+            states  : (N, 6) ECI states of the first sc [km, km/s]
+            times   : (N,) int64 microseconds since epoch
+            B       : (N, 3) magnetic field in the ellipsoidal frame [uT]
+            ephemeris/sc<i> : optional Chebyshev_Ephemeris groups
+
+        Every dataset is chunked along time and gzip compressed. Frames that are functions of the
+        states (R, H, OE_, LALN, R_ECEF, ...) are not stored, Sim_File calculates them for the rows
+        that are read. Version 1 files, with a dataset per frame under states/ECI, states/angular
+        and states/ECEF, can still be read.
+
+"""
+
+import collections
+import datetime as dt
+
+import h5py
+import numpy as np
+
+import PySOL.constants as constants
+import PySOL.orb_tools as ot
+import PySOL.time_tools as tt
+from PySOL.ephemeris import Chebyshev_Ephemeris
+
+LAYOUT_VERSION = 2
+
+# Rows per HDF5 chunk, and per block read and cached by Sim_File
+CHUNK_ROWS = 4096
+
+# Compression of every dataset
+COMPRESSION = dict(compression = 'gzip', compression_opts = 4, shuffle = True)
+
+# Frames stored by version 1 files, read as saved rather than recalculated
+LEGACY_DATASETS = {
+    'X': 'states/ECI/X', 'Y': 'states/ECI/Y', 'Z': 'states/ECI/Z',
+    'VX': 'states/ECI/VX', 'VY': 'states/ECI/VY', 'VZ': 'states/ECI/VZ',
+    'R': 'states/ECI/R', 'V': 'states/ECI/V', 'H': 'states/ECI/H',
+    'OE_': 'states/angular/OE', 'RADEC': 'states/angular/RADEC', 'LALN': 'states/angular/LALN',
+    'R_ECEF': 'states/ECEF/r_', 'B': 'B/B',
+}
+
+
+def sim_datasets(ST_MT, epoch, B = None, save_states = True, save_times = True, save_B = True):
+    """
+        sim_datasets - datasets of a saved simulation, by their path in the file
+
+            Args:
+                ST_MT (State_Matrix): states of the saved sc
+                epoch (datetime64): epoch of the times dataset
+                B (3xN array): magnetic field of the sc [nT]
+                save_states, save_times, save_B (bool): datasets to include
+
+            Returns:
+                datasets (dict): dataset path to data
+    """
+
+    datasets = {}
+
+    if save_states:
+        datasets['states'] = ST_MT.S_
+
+    if save_times:
+        datasets['times'] = (tt.to_datetime64(ST_MT.times) - np.datetime64(epoch, 'us')).astype(np.int64)
+
+    if save_B:
+        datasets['B'] = B.astype(np.double).T*1e-3
+
+    return datasets
+
+def write_attrs(f, epoch, dt_sec, n_sc, model_name):
+    """
+        write_attrs - file attributes of a saved simulation, tf is set by the writer once known
+
+            Args:
+                f (h5py File): open simulation file
+                epoch (datetime64): UTC time of the first saved state
+                dt_sec (float): output time spacing in seconds
+                n_sc (int): number of sc in the simulation
+                model_name (str): dynamical model name
+    """
+
+    f.attrs['version'] = LAYOUT_VERSION
+    f.attrs['epoch'] = str(np.datetime64(epoch, 'us'))
+    f.attrs['t0'] = tt.datetime_to_jd(epoch)[0]
+    f.attrs['dt'] = dt_sec
+    f.attrs['N Sc'] = n_sc
+    f.attrs['Dyn Model'] = model_name
+
+def append_datasets(f, datasets):
+    """
+        append_datasets - appends rows to resizable datasets, creating them on the first call
+
+            Args:
+                f (h5py File): open simulation file
+                datasets (dict): dataset path to the rows to append
+    """
+
+    for name, data in datasets.items():
+        data = np.asarray(data)
+
+        if name not in f:
+            f.create_dataset(name = name, data = data, maxshape = (None,) + data.shape[1:],
+                chunks = (CHUNK_ROWS,) + data.shape[1:], **COMPRESSION)
+        else:
+            dset = f[name]
+            n = dset.shape[0]
+            dset.resize(n + data.shape[0], axis = 0)
+            dset[n:] = data
+
+
+class Sim_Frame():
+    """
+        Sim_Frame - one frame of a Sim_File, read from disk only for the rows that are indexed.
+            Indexes like a numpy array, oat.LALN[i, 0], oat.X[0:n], len(oat.X), np.asarray(oat.B)
+    """
+
+    def __init__(self, sim_file, name):
+
+        self.sim_file = sim_file
+        self.name = name
+
+    def __len__(self):
+        return len(self.sim_file)
+
+    @property
+    def shape(self):
+        return (len(self),) + self[0:1].shape[1:]
+
+    def __getitem__(self, key):
+
+        rows, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+
+        if isinstance(rows, (int, np.integer)):
+            n = len(self)
+            row = rows + n if rows < 0 else rows
+            if not 0 <= row < n:
+                raise IndexError('Index {} out of range for {} rows'.format(rows, n))
+
+            block = self.sim_file.block(self.name, row//self.sim_file.block_rows)
+            data = block[row % self.sim_file.block_rows]
+        elif isinstance(rows, slice):
+            start, stop, step = rows.indices(len(self))
+            if step < 0:
+                return self[:][key]
+            data = self.sim_file.frame(self.name, start, max(start, stop))[::step]
+        else:
+            data = self.sim_file.frame(self.name, 0, len(self))[rows]
+
+        if not rest:
+            return data
+
+        # An integer index drops the row axis, other row indexes keep it
+        return data[rest] if isinstance(rows, (int, np.integer)) else data[(slice(None),) + rest]
+
+    def __array__(self, dtype = None, copy = None):
+
+        data = self[:]
+
+        return data if dtype is None else data.astype(dtype)
+
+
+class Sim_File():
+
+    def __init__(self, file_path, block_rows = CHUNK_ROWS, cache_blocks = 32):
+        """
+            Sim_File - lazy reader of a saved simulation. Frames are attributes that read and
+                calculate rows on demand, single rows are served from a cache of whole blocks
+                so that stepping through a simulation decompresses every chunk once
+
+                Args:
+                    file_path (str): path of the simulation file
+                    block_rows (int): rows per cached block
+                    cache_blocks (int): number of blocks kept in the cache
+        """
+
+        self.file = h5py.File(file_path, 'r')
+        self.version = int(self.file.attrs.get('version', 1))
+
+        attrs = self.file.attrs
+        self.dt = attrs['dt']
+        self.t0 = attrs['t0']
+        self.tf = attrs.get('tf')
+        self.n_sc = attrs.get('N Sc')
+        self.model_nm = attrs.get('Dyn Model')
+
+        if self.version == 1:
+            self.states_dset = self.file['states/ECI/S_']
+            self.times_dset = self.file['times/JD']
+            self.B_dsets = [self.file['B/Bx'], self.file['B/By'], self.file['B/Bz']] if 'B' in self.file else None
+        else:
+            self.states_dset = self.file['states']
+            self.times_dset = self.file['times']
+            self.B_dsets = self.file['B'] if 'B' in self.file else None
+            self.epoch = np.datetime64(attrs['epoch'], 'us')
+
+        self.block_rows = block_rows
+        self.cache_blocks = cache_blocks
+        self.cache = collections.OrderedDict()
+
+        self.Re = constants.R_E()
+
+        for name in self.frames:
+            setattr(self, name, Sim_Frame(self, name))
+
+    def __len__(self):
+        return self.times_dset.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.cache.clear()
+        self.file.close()
+
+    def read_states(self, i, j):
+        return self.states_dset[i:j]
+
+    def read_times(self, i, j):
+        """
+            read_times - UTC times of rows i to j as datetime64
+        """
+
+        if self.version == 1:
+            return tt.jd_to_datetime64(self.times_dset[i:j])
+
+        return self.epoch + self.times_dset[i:j].astype('timedelta64[us]')
+
+    def read_jd(self, i, j):
+
+        if self.version == 1:
+            return self.times_dset[i:j]
+
+        return tt.datetime_to_jd(self.read_times(i, j))
+
+    def read_B(self, i, j):
+        """
+            read_B - magnetic field of rows i to j, (j - i, 3) [uT]
+        """
+
+        if self.B_dsets is None:
+            raise Exception('Simulation file has no magnetic field saved!')
+
+        if self.version == 1:
+            return np.stack([dset[i:j] for dset in self.B_dsets], axis = 1)
+
+        return self.B_dsets[i:j]
+
+    # Calculation of every frame from rows i to j, as in State_Matrix
+    frames = {
+        'S_': lambda self, i, j: self.read_states(i, j),
+        'R_': lambda self, i, j: self.read_states(i, j)[:, 0:3],
+        'V_': lambda self, i, j: self.read_states(i, j)[:, 3:6],
+        'X': lambda self, i, j: self.read_states(i, j)[:, 0],
+        'Y': lambda self, i, j: self.read_states(i, j)[:, 1],
+        'Z': lambda self, i, j: self.read_states(i, j)[:, 2],
+        'VX': lambda self, i, j: self.read_states(i, j)[:, 3],
+        'VY': lambda self, i, j: self.read_states(i, j)[:, 4],
+        'VZ': lambda self, i, j: self.read_states(i, j)[:, 5],
+        'R': lambda self, i, j: np.linalg.norm(self.read_states(i, j)[:, 0:3], axis = 1),
+        'V': lambda self, i, j: np.linalg.norm(self.read_states(i, j)[:, 3:6], axis = 1),
+        'H': lambda self, i, j: np.linalg.norm(self.read_states(i, j)[:, 0:3], axis = 1) - self.Re,
+        'OE_': lambda self, i, j: ot.calc_RV2OE_batch(self.read_states(i, j)),
+        'RADEC': lambda self, i, j: ot.calc_R2RADEC_batch(self.read_states(i, j)[:, 0:3]),
+        'LALN': lambda self, i, j: ot.calc_LALN_batch(self.read_states(i, j)[:, 0:3], self.read_jd(i, j)),
+        'R_ECEF': lambda self, i, j: ot.calc_ECEF_batch(self.read_states(i, j)[:, 0:3], self.read_jd(i, j)),
+        'B_': lambda self, i, j: self.read_B(i, j),
+        'B': lambda self, i, j: np.linalg.norm(self.read_B(i, j), axis = 1),
+        'Bx': lambda self, i, j: self.read_B(i, j)[:, 0],
+        'By': lambda self, i, j: self.read_B(i, j)[:, 1],
+        'Bz': lambda self, i, j: self.read_B(i, j)[:, 2],
+        'times': lambda self, i, j: self.read_times(i, j),
+        'times_jd': lambda self, i, j: self.read_jd(i, j),
+        'times_utc': lambda self, i, j: self.read_times(i, j).astype(dt.datetime),
+    }
+
+    def frame(self, name, i, j):
+        """
+            frame - reads and calculates a frame for rows i to j
+        """
+
+        if self.version == 1 and name in LEGACY_DATASETS and LEGACY_DATASETS[name] in self.file:
+            return self.file[LEGACY_DATASETS[name]][i:j]
+
+        return self.frames[name](self, i, j)
+
+    def block(self, name, k):
+        """
+            block - frame of the k-th block of rows, kept in a least recently used cache
+        """
+
+        key = (name, k)
+
+        if key in self.cache:
+            self.cache.move_to_end(key)
+        else:
+            self.cache[key] = self.frame(name, k*self.block_rows, (k + 1)*self.block_rows)
+            if len(self.cache) > self.cache_blocks:
+                self.cache.popitem(last = False)
+
+        return self.cache[key]
+
+    def ephemeris(self, sc = 0):
+        """
+            ephemeris - Chebyshev_Ephemeris of a sc, when saved with save_ephemeris
+        """
+
+        return Chebyshev_Ephemeris.load(self.file['ephemeris/sc{}'.format(sc)])
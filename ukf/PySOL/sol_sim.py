@@ -18,6 +18,7 @@ import astropy.time as astro_time
 
 import os
 import h5py
+import multiprocessing
 import datetime as dt
 import numpy as np
 import scipy.integrate as sci
@@ -27,6 +28,8 @@ import PySOL.constants as constants
 import geopandas as gpd
 
 from PySOL.wmm import WMM
+from PySOL.ephemeris import Chebyshev_Ephemeris
+import PySOL.sim_file as sf
 
 countries = gpd.read_file(gpd.datasets.get_path("naturalearth_lowres"))
 
@@ -44,6 +47,142 @@ countries = gpd.read_file(gpd.datasets.get_path("naturalearth_lowres"))
 #  "ne_110m_graticules_10/ne_110m_graticules_10.shp"
 # )
 
+def sim_file_path(file_name = None):
+    """
+        sim_file_path - path of a new simulation file in save_sim/, numbering
+            the file when one of the same name already exists
+
+            Args:
+                file_name (str): file name without extension, defaults to the date
+
+            Returns:
+                file_path (str): path of the file to write
+    """
+
+    if file_name == None:
+        file_name = dt.datetime.now().strftime("%Y-%m-%d_PySol")
+    file_path = 'save_sim/{}.hdf5'.format(file_name)
+
+    ### Handles multiple saved files for a given day, run
+    exists = os.path.exists(file_path)
+    i = 0
+    while exists == True:
+        i += 1
+        i_str = str(i)
+        temp_name = '_'.join([file_name, i_str])
+        temp_path = 'save_sim/{}.hdf5'.format(temp_name)
+        exists = os.path.exists(temp_path)
+    if i >0:
+        file_path = temp_path
+
+    return file_path
+
+def integrate_orbit(state_func, state, dt_sec, n_outputs, tol, integrator, event_func):
+    """
+        integrate_orbit - integrates one sc state forward, shared by the serial
+            and parallel propogation of Simulation
+
+            Args:
+                state_func (function): state derivative function, F(t, S)
+                state (1x6 array): initial ECI state
+                dt_sec (float): integration time in seconds
+                n_outputs (int): number of integration outputs
+                tol (tuple): absolute and relative integration tolerance
+                integrator (str): num. integration method to use
+                event_func: func to record events
+
+            Returns:
+                s_new (Nx6): sc states at each t_eval
+                t_new (N): evaluated times
+    """
+
+    # Set up integration
+    t_eval = np.linspace(0, dt_sec, n_outputs)
+
+    # https://docs.scipy.org/doc/scipy/reference/generated/scipy.integrate.solve_ivp.html
+    # Numerical integration 
+    sol = sci.solve_ivp(
+        fun = state_func,       # Integrtion func
+        y0 = state,             # Initial state
+        t_span = [0, dt_sec],   # Init/Final int time
+        method = integrator,    # Int Algorithm
+        t_eval = t_eval,        # Times to output
+        max_step = 10,          # Max time step [s] in int
+        atol = tol[0],
+        rtol = tol[1],
+        #args = [eval_STM, p_event, epoch],
+        events = event_func
+    )
+
+    # propogated states and time arrays
+    s_new = sol.y.T
+    t_new = sol.t.T
+
+    return s_new, t_new
+
+def integrate_orbits_rk4(state_func_batch, states, dt_sec, n_outputs, max_step):
+    """
+        integrate_orbits_rk4 - fixed step Runge Kutta 4 integration of many sc at once,
+            advancing their (N, 6) block of states in every array operation. Each output
+            interval is split into equal steps of at most max_step seconds, so that the
+            outputs land on the same times as integrate_orbit
+
+            Args:
+                state_func_batch (function): state derivative function of a state block, F(t, S)
+                states (Nx6 array): initial ECI states
+                dt_sec (float): integration time in seconds
+                n_outputs (int): number of integration outputs
+                max_step (float): largest integration step in seconds
+
+            Returns:
+                sc_props (list): (s_new (n_outputs x 6), t_new (n_outputs)) of every sc
+    """
+
+    t_eval = np.linspace(0, dt_sec, n_outputs)
+    spacing = t_eval[1] - t_eval[0] if n_outputs > 1 else 0.0
+
+    n_steps = max(1, int(np.ceil(spacing/max_step)))
+    h = spacing/n_steps
+
+    S = np.array(states, dtype = np.double)
+    s_new = np.empty((n_outputs,) + S.shape)
+    s_new[0] = S
+
+    for k in range(1, n_outputs):
+        t = t_eval[k-1]
+        for j in range(n_steps):
+            k1 = state_func_batch(t, S)
+            k2 = state_func_batch(t + h/2, S + h/2*k1)
+            k3 = state_func_batch(t + h/2, S + h/2*k2)
+            k4 = state_func_batch(t + h, S + h*k3)
+
+            S = S + h/6*(k1 + 2*k2 + 2*k3 + k4)
+            t += h
+
+        s_new[k] = S
+
+    return [(s_new[:, i], t_eval) for i in range(S.shape[0])]
+
+def propogate_worker(job):
+    """
+        propogate_worker - integrate_orbit on a process of a pool, rebuilding the
+            dynamical model from its name so that only arrays are sent between processes
+
+            Args:
+                job (tuple): model name, initial state, then the remaining
+                    arguments of integrate_orbit
+
+            Returns:
+                s_new (Nx6): sc states at each t_eval
+                t_new (N): evaluated times
+    """
+
+    model_name, state, dt_sec, n_outputs, tol, integrator, event_func = job
+    state_func = models.Orbital_Models(model_name).get_state_func()
+
+    return integrate_orbit(state_func, state, dt_sec, n_outputs, tol, integrator, event_func)
+
+
 class Simulation():
 
     def __init__(self, model_name = 'Two-Body', mag_deg = 1, TIME = None):
@@ -78,6 +217,7 @@ class Simulation():
 
         # State integration function
         self.state_func = model.get_state_func()
+        self.state_func_batch = model.get_state_func_batch()
 
         # Set simulation clock
         if TIME == None:
@@ -109,13 +249,14 @@ class Simulation():
         # Time of init is taken from current sim time
         TIME = self.time
 
-        sc = sp.Spacecraft(OE_array, TIME, verbose = verbose, color = color, name = name)
+        sc = sp.Spacecraft(OE_array, TIME, verbose = verbose, color = color, name = name, 
+            state_func_batch = self.state_func_batch)
         self.scs.append(sc)
 
         return sc
 
     def propogate(self, DT, resolution = 10, tol = [1e-7, 1e-4], integrator = 'RK45', 
-        event_func = None):
+        event_func = None, step = 1.0):
         """
             propogate - propogates sc and simulation forward in time using dynamical model
 
@@ -124,8 +265,11 @@ class Simulation():
                 resolution (float) : output time spacing in seconds
                 tol (1x2 list) : tolerance of RK integrator
                 integrator (str) : num. integration method to use 
-                    ['RK23', 'RK45', 'DOP853', 'Radau']
+                    ['RK23', 'RK45', 'DOP853', 'Radau'], or 'RK4' to integrate
+                    every sc at once with fixed steps, or 'Kepler' to solve the
+                    Two-Body model analytically (tol and event_func unused by both)
                 event_func (function) : function to record events
+                step (float) : largest step in seconds of the 'RK4' integrator
 
             Return:
                 None
@@ -136,24 +280,175 @@ class Simulation():
         n_outputs = int(dt_seconds/resolution)
 
         # Propogate each sc and record output to sc object
-        for i, sc in enumerate(self.scs):
-            sc_props = self.propogate_func(sc, dt_seconds, n_outputs, tol, integrator, event_func)
+        states = np.array([sc.state_mat.S_[-1] for sc in self.scs])
+        sc_props = self.integrate_states(states, dt_seconds, n_outputs, tol, integrator, event_func, step)
+
+        self.record_propogation(sc_props)
+
+    def integrate_states(self, states, dt_seconds, n_outputs, tol, integrator, event_func, step):
+        """
+            integrate_states - integrates the states of every sc with the chosen integrator,
+                shared by propogate and propogate_to_file
+
+            Args:
+                states (Nx6 array) : initial ECI state of every sc
+                dt_seconds (float) : integration time in seconds
+                n_outputs (int) : number of integration outputs, including the initial state
+                tol, integrator, event_func, step : as in propogate
+
+            Return:
+                sc_props (list) : (states, times) of every sc, times in seconds from the start
+        """
+
+        if integrator == 'RK4':
+            return integrate_orbits_rk4(self.state_func_batch, states, dt_seconds, n_outputs, step)
+
+        if integrator == 'Kepler':
+            if self.model_nm != 'Two-Body':
+                raise Exception('Kepler propogation only solves the Two-Body model!')
+            t_eval = np.linspace(0, dt_seconds, n_outputs)
+            s_new = ot.calc_kepler(states, t_eval)
+            return [(s_new[:, i], t_eval) for i in range(len(states))]
+
+        return [integrate_orbit(self.state_func, state, dt_seconds, n_outputs, tol, integrator, event_func) for state in states]
+
+    def propogate_to_file(self, DT, file_name = None, resolution = 10, chunk = dt.timedelta(hours = 1),
+        tol = [1e-7, 1e-4], integrator = 'RK45', event_func = None, step = 1.0, save_B = True):
+        """
+            propogate_to_file - propogates the sim in chunks of time, appending every chunk of 
+                the first sc to resizable HDF5 datasets as it is integrated. Datasets are laid
+                out like save_sim, so memory stays bounded by the chunk length however long DT is
+
+                Outputs are spaced exactly resolution seconds apart. After each chunk the sc only
+                keep their last state, so the full trajectory is only held by the file
+
+            Args:
+                DT (datetime.timedelta) : time of integration
+                file_name (str) : name of the file in save_sim/, defaults to the date
+                resolution (float) : output time spacing in seconds
+                chunk (datetime.timedelta) : time integrated and written at once
+                tol, integrator, event_func, step : as in propogate
+                save_B (bool) : calculate and save the magnetic field of every chunk
+
+            Return:
+                file_path (str) : path of the saved simulation
+        """
+
+        total_seconds = DT.total_seconds()
+        n_total = int(round(total_seconds/resolution))
+        n_chunk = max(1, int(round(chunk.total_seconds()/resolution)))
+
+        file_path = sim_file_path(file_name)
+
+        with h5py.File(file_path, "a") as f:
+
+            t_start = np.datetime64(self.time, 'us')
+
+            sf.write_attrs(f, t_start, resolution, len(self.scs), self.model_nm)
+
+            # The first row of the file is the current state
+            sc = self.scs[0]
+            first = ot.State_Matrix(sc.state_mat.S_[-1:], np.array([t_start]))
+            sf.append_datasets(f, sf.sim_datasets(first, t_start, self.chunk_B(first) if save_B else None, save_B = save_B))
+
+            done = 0
+            while done < n_total:
+                n = min(n_chunk, n_total - done)
+
+                states = np.array([sc.state_mat.S_[-1] for sc in self.scs])
+                sc_props = self.integrate_states(states, n*resolution, n + 1, tol, integrator, event_func, step)
+
+                # Chunk times, counted from the start of the run so they do not drift
+                k = np.arange(done + 1, done + n + 1)
+                times = t_start + np.rint(k*resolution*1e6).astype('timedelta64[us]')
+
+                for i, (s_new, t_s) in enumerate(sc_props):
+                    ST_MT = ot.State_Matrix(s_new[1:], times)
+
+                    if i == 0:
+                        B = self.chunk_B(ST_MT) if save_B else None
+                        sf.append_datasets(f, sf.sim_datasets(ST_MT, t_start, B, save_B = save_B))
+
+                    # Only keep the last state, integration of the next chunk starts from it
+                    self.scs[i].state_mat = ot.State_Matrix(s_new[-1:], times[-1:])
+
+                done += n
+                self.time = times[-1].astype(dt.datetime)
+                f.attrs['tf'] = astro_time.Time(self.time).jd
+
+                print('Propogated {:.0f}/{:.0f} s..'.format(done*resolution, total_seconds))
+
+        self.times = [self.time]
+
+        print('Simulation file saved to ' + file_path)
+
+        return file_path
+
+    def chunk_B(self, ST_MT):
+        """
+            chunk_B - magnetic field along a state matrix, as calculated by Spacecraft.calc_B
+        """
+
+        return sp.calc_state_B(ST_MT, self.mag_model)
+
+    def propogate_parallel(self, DT, resolution = 10, tol = [1e-7, 1e-4], integrator = 'RK45', 
+        event_func = None, processes = None):
+        """
+            propogate_parallel - propogates every sc at once on a pool of processes,
+                giving the same results as propogate. Each process integrates from 
+                the sc's last state and only ships back its state and time arrays
+
+                Scripts calling this need an if __name__ == '__main__' guard on
+                platforms that start processes with spawn (Windows, macOS)
+
+            Args:
+                DT (datetime.timedelta) : time of integration
+                resolution (float) : output time spacing in seconds
+                tol (1x2 list) : tolerance of RK integrator
+                integrator (str) : num. integration method to use 
+                    ['RK23', 'RK45', 'DOP853', 'Radau']
+                event_func (function) : function to record events, must be
+                    defined at module level so it can be sent to the processes
+                processes (int) : number of processes, defaults to the cpu count
+
+            Return:
+                None
+        """
+
+        dt_seconds = DT.seconds
+        n_outputs = int(dt_seconds/resolution)
+
+        jobs = [(self.model_nm, sc.state_mat.S_[-1], dt_seconds, n_outputs, tol, integrator, event_func) for sc in self.scs]
+
+        with multiprocessing.Pool(processes) as pool:
+            sc_props = pool.map(propogate_worker, jobs)
+
+        self.record_propogation(sc_props)
+
+    def record_propogation(self, sc_props):
+        """
+            record_propogation - adds propogated states and times to every sc
+                and advances the sim clock
+
+            Args:
+                sc_props (list) : (states, times) of every sc, as returned by
+                    propogate_func, with times in seconds from the sim time
+        """
+
+        t0 = np.datetime64(self.time, 'us')
+
+        for i, (states, t_s) in enumerate(sc_props):
             
-            # Add new datetime objects to sc time list
-            t_s = sc_props[1]
-            times = []
-            for s in t_s:
-                delta_t = dt.timedelta(seconds  = s)
-                times.append(self.time + delta_t)
+            # New times of the sc, to the microsecond like datetime.timedelta
+            times = t0 + np.rint(np.asarray(t_s)*1e6).astype('timedelta64[us]')
 
             # Add new state vectors to sc time list
-            states = sc_props[0]
             self.scs[i].set_states(states[1:], times[1:])### First item is a repeat of init
             self.scs[i].set_times(times[1:])
         
         # Set the sim time to the last sc recorded time
-        self.time = times[-1]
-        self.times = times
+        self.time = times[-1].astype(dt.datetime)
+        self.times = times.astype(dt.datetime).tolist()
 
     def propogate_func(self, sc, dt_sec, n_outputs, tol, integrator, event_func):
         """
@@ -180,30 +475,7 @@ class Simulation():
                          
         """
 
-        # Set up integration
-        state = sc.state_mat.S_[-1]
-        t_eval = np.linspace(0, dt_sec, n_outputs)
-
-        # https://docs.scipy.org/doc/scipy/reference/generated/scipy.integrate.solve_ivp.html
-        # Numerical integration 
-        sol = sci.solve_ivp(
-            fun = self.state_func,  # Integrtion func
-            y0 = state,             # Initial state
-            t_span = [0, dt_sec],   # Init/Final int time
-            method = integrator,    # Int Algorithm
-            t_eval = t_eval,        # Times to output
-            max_step = 10,          # Max time step [s] in int
-            atol = tol[0],
-            rtol = tol[1],
-            #args = [eval_STM, p_event, epoch],
-            events = event_func
-        )
-
-        # propogated states and time arrays
-        s_new = sol.y.T
-        t_new = sol.t.T
-
-        return s_new, t_new
+        return integrate_orbit(self.state_func, sc.state_mat.S_[-1], dt_sec, n_outputs, tol, integrator, event_func)
 
     def calc_B(self):
         if self.calculated_B:
@@ -214,90 +486,54 @@ class Simulation():
         for sc in self.scs:
             sc.calc_B(mag_model = self.mag_model)
 
+    def fit_ephemeris(self, tol = 1e-5, degree = 12):
+        """
+            fit_ephemeris - fits every spacecraft trajectory with a piecewise Chebyshev ephemeris
+
+                Opt. Args:
+                    tol (float): largest position error at any propogated state [km]
+                    degree (int): degree of the Chebyshev series of every segment
+
+                Returns:
+                    ephemerides (list of Chebyshev_Ephemeris): one per spacecraft, also set as sc.ephemeris
+        """
+
+        for sc in self.scs:
+            sc.ephemeris = Chebyshev_Ephemeris.fit(sc.state_mat.times, sc.state_mat.S_, tol, degree)
+
+        return [sc.ephemeris for sc in self.scs]
+
     def save_sim(self, file_name = None, save_states = True, save_times = True, 
-                    save_B = True):
-
-        if file_name == None:
-            file_name = dt.datetime.now().strftime("%Y-%m-%d_PySol")
-        file_path = 'save_sim/{}.hdf5'.format(file_name)
-
-        ### Handles multiple saved files for a given day, run
-        exists = os.path.exists(file_path)
-        i = 0
-        while exists == True:
-            i += 1
-            i_str = str(i)
-            temp_name = '_'.join([file_name, i_str])
-            temp_path = 'save_sim/{}.hdf5'.format(temp_name)
-            exists = os.path.exists(temp_path)
-        if i >0:
-            file_path = temp_path
-        #######################################################
-            
+                    save_B = True, save_ephemeris = False, ephemeris_tol = 1e-5):
+
+        file_path = sim_file_path(file_name)
 
         sc = self.scs[0] # only saving the first spacecraft trajectory
         ST_MT = sc.state_mat
         # Open file 
         f = h5py.File(file_path, "a")
 
-        f.attrs['t0'] = astro_time.Time(self.t0).jd
-        f.attrs['tf'] = astro_time.Time(self.time).jd
-
         times = ST_MT.times
         dt = times[3] - times[2]
-        f.attrs['dt'] = dt.total_seconds()
 
-        f.attrs['N Sc'] = len(self.scs)
-        f.attrs['Dyn Model'] = self.model_nm
+        sf.write_attrs(f, times[0], dt.total_seconds(), len(self.scs), self.model_nm)
+        f.attrs['tf'] = astro_time.Time(self.time).jd
         # f.attrs['Mag Model'] = self.mag_model
 
-        if save_states:
-            states_grp = f.create_group('states')
-
-            ECI_states = states_grp.create_group('ECI')
-            #### ECI States ####
-            ECI_states.create_dataset(name = 'S_', data = ST_MT.S_)
-            ECI_states.create_dataset(name = 'R_', data = ST_MT.R_)
-            ECI_states.create_dataset(name = 'V_', data = ST_MT.V_)
-            ECI_states.create_dataset(name = 'R', data = ST_MT.R)
-            ECI_states.create_dataset(name = 'V', data = ST_MT.V)
-            ECI_states.create_dataset(name = 'X', data = ST_MT.X)
-            ECI_states.create_dataset(name = 'Y', data = ST_MT.Y)
-            ECI_states.create_dataset(name = 'Z', data = ST_MT.Z)
-            ECI_states.create_dataset(name = 'VX', data = ST_MT.VX)
-            ECI_states.create_dataset(name = 'VY', data = ST_MT.VY)
-            ECI_states.create_dataset(name = 'VZ', data = ST_MT.VZ)
-            ECI_states.create_dataset(name = 'H', data = ST_MT.H)
-
-            ang_states = states_grp.create_group('angular')
-            ang_states.create_dataset(name = 'OE', data = ST_MT.OE_)
-            ang_states.create_dataset(name = 'RADEC', data = ST_MT.RADEC)
-            ang_states.create_dataset(name = 'LALN', data = ST_MT.LALN)
-
-            ECEF_states = states_grp.create_group('ECEF')
-            ECEF_states.create_dataset(name = 'r_', data = ST_MT.R_ECEF)
-            ECEF_states.create_dataset(name = 'x', data = ST_MT.R_ECEF[:, 0])
-            ECEF_states.create_dataset(name = 'y', data = ST_MT.R_ECEF[:, 1])
-            ECEF_states.create_dataset(name = 'z', data = ST_MT.R_ECEF[:, 2])
+        sf.append_datasets(f, sf.sim_datasets(ST_MT, times[0], sc.B_ if save_B else None, save_states, save_times, save_B))
 
+        if save_states:
             print('Saved states..')
-
         if save_times:
-            times_grp = f.create_group('times')
-            #times_grp.create_dataset(name = 'UTC', data = ST_MT.times)
-            times_grp.create_dataset(name = 'JD', data = ST_MT.times_jd)
-
             print('Saved times..')
 
-        if save_B:
-            B_grp = f.create_group('B')
-
-            B = sc.B_.astype(np.double)
-            B_grp.create_dataset(name = 'B', data = np.linalg.norm(B, axis = 0)*1e-3)
-            B_grp.create_dataset(name = 'Bx', data = B[0]*1e-3)
-            B_grp.create_dataset(name = 'By', data = B[1]*1e-3)
-            B_grp.create_dataset(name = 'Bz', data = B[2]*1e-3)
+        if save_ephemeris:
+            # Chebyshev coefficients of every spacecraft, enough to evaluate a state at any epoch
+            eph_grp = f.create_group('ephemeris')
+            for i, eph in enumerate(self.fit_ephemeris(ephemeris_tol)):
+                eph.save(eph_grp.create_group('sc{}'.format(i)))
 
+            print('Saved ephemeris..')
 
         print('HDF5 file saving is donezo..')
         print('Simulation file saved to ' + file_path)
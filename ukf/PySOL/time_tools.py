@@ -0,0 +1,198 @@
+"""
+    time_tools.py - vectorized time utilities for orbit post-processing
+
+        Epochs are kept as float64 UTC Julian dates (or seconds since t0) and converted for whole arrays in
+        one pass, instead of one datetime at a time through astropy or Python arithmetic.
+
+        Checked against astropy for 2000-2023 (run this module to repeat the check):
+            Julian dates        : < 1e-9 days (~0.1 ms, float64 resolution of a Julian date is ~40 us)
+            decimal years       : < 1e-12 years, or < 5e-8 years (~1 s) in years with a leap second
+            GMST (calc_gmst)    : < 5e-3 deg against astropy's IAU 2006 mean sidereal time. This comes from the
+                                  truncated series of Curtis (eq 5.50) also used by orb_tools.calc_th_0, and from
+                                  taking UT1 = UTC (|UT1 - UTC| < 0.9 s, ~4e-3 deg)
+
+        Leap seconds are not modelled: every UTC day is taken to be 86400 s long, so Julian dates inside a day
+        that ends with a leap second can be off by up to 1 s.
+
+"""
+
+import datetime as dt
+import numpy as np
+
+# J2000 epoch (2000-01-01 12:00 UTC) as a datetime64 and as a Julian date
+J2000 = np.datetime64('2000-01-01T12:00:00', 'us')
+JD_J2000 = 2_451_545.0
+
+# Microseconds in a day
+US_PER_DAY = 86_400e6
+
+
+def to_datetime64(times):
+    """
+        to_datetime64 - converts datetimes to a microsecond datetime64 array
+
+            Args:
+                times (datetime, list or array of datetimes, or datetime64 array): UTC times
+
+            Returns:
+                times64 (N array): times as datetime64[us]
+    """
+
+    return np.atleast_1d(np.asarray(times, dtype = 'datetime64[us]'))
+
+
+def datetime_to_jd(times):
+    """
+        datetime_to_jd - UTC Julian dates of an array of times
+
+            Args:
+                times (datetime, list or array of datetimes, or datetime64 array): UTC times
+
+            Returns:
+                JD (N array): UTC Julian dates
+    """
+
+    return JD_J2000 + (to_datetime64(times) - J2000).astype(np.double)/US_PER_DAY
+
+
+def jd_to_datetime64(JD):
+    """
+        jd_to_datetime64 - times of an array of UTC Julian dates, rounded to the microsecond
+
+            Args:
+                JD (N array): UTC Julian dates
+
+            Returns:
+                times64 (N array): times as datetime64[us]
+    """
+
+    offset = np.rint((np.atleast_1d(np.asarray(JD, dtype = np.double)) - JD_J2000)*US_PER_DAY)
+
+    return J2000 + offset.astype('timedelta64[us]')
+
+
+def jd_to_datetime(JD):
+    """
+        jd_to_datetime - jd_to_datetime64, as an array of datetime objects
+
+            Args:
+                JD (N array): UTC Julian dates
+
+            Returns:
+                times (N array): datetime objects
+    """
+
+    return jd_to_datetime64(JD).astype(dt.datetime)
+
+
+def seconds_since(times, t0):
+    """
+        seconds_since - seconds from t0 to every time
+
+            Args:
+                times (datetime, list or array of datetimes, or datetime64 array): UTC times
+                t0 (datetime or datetime64): reference UTC time
+
+            Returns:
+                seconds (N array): elapsed seconds
+    """
+
+    return (to_datetime64(times) - np.datetime64(t0, 'us')).astype(np.double)*1e-6
+
+
+def decimal_year(times):
+    """
+        decimal_year - orb_tools.dt_to_dec for an array of times
+
+            Args:
+                times (datetime, list or array of datetimes, or datetime64 array): UTC times
+
+            Returns:
+                years (N array): decimal years, year + fraction of that year elapsed
+    """
+
+    times64 = to_datetime64(times)
+
+    year = times64.astype('datetime64[Y]')
+    year_start = year.astype('datetime64[us]')
+    year_end = (year + 1).astype('datetime64[us]')
+
+    fraction = (times64 - year_start).astype(np.double)/(year_end - year_start).astype(np.double)
+
+    return year.astype(np.double) + 1970 + fraction
+
+
+def jd_to_decimal_year(JD):
+    """
+        jd_to_decimal_year - decimal years of an array of UTC Julian dates
+
+            Args:
+                JD (N array): UTC Julian dates
+
+            Returns:
+                years (N array): decimal years
+    """
+
+    return decimal_year(jd_to_datetime64(JD))
+
+
+def calc_gmst(JD):
+    """
+        calc_gmst - Greenwich sidereal angle of an array of UTC Julian dates, using the same series
+            as orb_tools.calc_th_0 (Curtis eq 5.48-5.50). Like calc_th_0, the result is not wrapped
+            back to [0, 360) after adding the rotation since 0 UTC
+
+            Args:
+                JD (N array): UTC Julian dates
+
+            Returns:
+                th_G_deg (N array): Greenwich sidereal angle in degrees
+    """
+
+    JD = np.asarray(JD, dtype = np.double)
+
+    # Hours since 0 UTC, Julian dates start at noon
+    UT = np.mod(JD - 0.5, 1)*24
+
+    ### Julian date at 0 UTC of this day
+    J_0 = JD - UT/24
+    T_0 = (J_0 - JD_J2000)/36_525
+
+    th_G0_deg = 100.4606184 + 36_000.77004*T_0 + 0.000387933*T_0**2 - 2.5831e-8*T_0**3
+
+    th_G0_deg_360 = th_G0_deg - np.floor(th_G0_deg/360)*360
+
+    th_G_deg = th_G0_deg_360 + 360.98564724*(UT/24)
+
+    return th_G_deg
+
+
+if __name__ == '__main__':
+
+    import astropy.time as astro_time
+    from astropy.utils import iers
+
+    # Use the IERS table shipped with astropy, which covers the checked range
+    iers.conf.auto_download = False
+
+    # Random times between 2000 and 2023, checked against astropy
+    rng = np.random.default_rng(0)
+    start = dt.datetime(2000, 1, 1)
+    times = [start + dt.timedelta(seconds = s) for s in rng.uniform(0, 23*365.25*86400, 10_000)]
+    astro = astro_time.Time(times, scale = 'utc')
+
+    # Days ending with a leap second, where astropy stretches the day to 86401 s
+    leap_days = [dt.date(2005, 12, 31), dt.date(2008, 12, 31), dt.date(2012, 6, 30), dt.date(2015, 6, 30), dt.date(2016, 12, 31)]
+    regular = np.array([time.date() not in leap_days for time in times])
+
+    JD = datetime_to_jd(times)
+    print('Julian date error [days]: {:.3e}'.format(np.max(np.abs(JD - astro.jd)[regular])))
+
+    print('Decimal year error [years]: {:.3e}'.format(np.max(np.abs(decimal_year(times) - astro.decimalyear))))
+
+    gmst_astro = astro.sidereal_time('mean', 'greenwich').deg
+    gmst_error = np.mod(calc_gmst(JD) - gmst_astro + 180, 360) - 180
+    print('GMST error [deg]: {:.3e}'.format(np.max(np.abs(gmst_error))))
+
+    round_trip = jd_to_datetime(JD)
+    print('Round trip error [s]: {:.3e}'.format(max(abs((a - b).total_seconds()) for a, b in zip(round_trip, times))))
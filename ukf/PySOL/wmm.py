@@ -2,14 +2,12 @@
     file WMMcoef.csv, which contains the values for the Gauss coefficients used to compute the
     magnetic field components.
 
-    This current version relies on the pyshtools library to calculate the needed Schmidt semi normalized associated
-    Legendre functions, in which the library actually loads from a .pyd file so it's hard to actually control how this is done >:(
-    Future implementations of this model will include a built-in script for directly calculating these legendre functions for more
-    efficiency rather than loading this pretty wack library
+    The needed Schmidt semi normalized associated Legendre functions and their derivatives are calculated by recursion
+    in legendre.py (ssn_legendre), and every (n, m) term of the field sums is evaluated for all points at once in calc_field
     
     The runtime of this implementation of the WMM model is:
-        ~0.03-0.04 s to define the model
-        ~0.02 to make a magnetic field calculation
+        ~0.001 s to define the model
+        ~0.002 s to make a magnetic field calculation at one point, ~0.05 s at 5000 points
     
     by Juwan Jeremy Jacobe
     
@@ -21,12 +19,61 @@
 '''
 
 from xml.sax.handler import DTDHandler
+import os
 import numpy as np
 import time
-# import pyshtools.legendre as legendre
 import matplotlib.pyplot as plt
 
-from PySOL.legendre import ssn_lpmv
+from PySOL.legendre import ssn_lpmv, ssn_legendre
+
+# Directory holding this module and its coefficient files
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def coefficient_path(file_name):
+    ''' Finds a coefficient file independently of the working directory. Absolute paths and paths that exist relative to
+    the working directory are used as given, anything else is looked up next to this module
+    
+    Args:
+        file_name (str): name or path of the coefficient file, such as 'WMMcoef.csv'
+        
+    Out:
+        path (str): path to the coefficient file
+    '''
+    
+    if os.path.isabs(file_name) or os.path.exists(file_name):
+        return file_name
+    return os.path.join(MODULE_DIR, file_name)
+
+def load_coefficients(file_name):
+    ''' Loads the packed (number of coefficients x 4) table of g, h, g_dot, h_dot from a coefficient csv. The csv is
+    parsed once and saved as a binary .npy file beside it, which is loaded directly from then on (and rebuilt whenever
+    the csv is newer)
+    
+    Args:
+        file_name (str): name or path of the coefficient csv
+        
+    Out:
+        data (np.array): rows of g, h, g_dot, h_dot, in order of n = 1 to 12 and m = 0 to n
+    '''
+    
+    csv_path = coefficient_path(file_name)
+    npy_path = os.path.splitext(csv_path)[0] + '.npy'
+    
+    if os.path.exists(npy_path) and (not os.path.exists(csv_path) or os.path.getmtime(npy_path) >= os.path.getmtime(csv_path)):
+        return np.load(npy_path)
+    
+    data = np.loadtxt(csv_path)
+    
+    # Write through a temporary file so that other processes never load a partial store
+    try:
+        temp_path = '{}.{}.tmp.npy'.format(os.path.splitext(npy_path)[0], os.getpid())
+        np.save(temp_path, data)
+        os.replace(temp_path, npy_path)
+    except OSError:
+        pass
+    
+    return data
+
 class WMMCoefficientLoader():
     ''' Class to load and hold model coefficients from reference epoch the WMM geomagnetic model for nth degree  
     model
@@ -54,13 +101,13 @@ class WMMCoefficientLoader():
         
     def read_coefficients(self, file_name):
         ''' This reads the Gauss coefficients from the .csv file within this directory to the class by using
-        numpy's loadtxt function
+        load_coefficients, which keeps a binary copy of the csv for fast loading
         
         Args:
             file_name (str): name of csv file to read coefficients from
         '''
         
-        data = np.loadtxt('ukf/PySOL/WMMcoef.csv')
+        data = load_coefficients(file_name)
         
         self.g_ = data[:, 0]
         self.h_ = data[:, 1]
@@ -90,31 +137,10 @@ class WMMCoefficientLoader():
             shaped_coefficient (tuple): a tuple where each element is an np-array of the m coefficients for a given nth degree
         '''
         
-        # Initial parameters
-        shaped_coefficient = []
-        n = 0
-        index = 0
-        
-        # Keep shaping until all n degree coefficients are shaped
-        while (n < self.degree):
-            row = np.array([])
-            
-            # Take the m -> [0, n] coefficients as one np array
-            for m in range(n+2):
-                row = np.append(row, coefficient[index+m])
-                
-            # Don't append if list is empty
-            if n == 0:
-                shaped_coefficient = [row]
-            # Else, append
-            else:
-                shaped_coefficient.append(row)
-            
-            # Incrementation
-            n += 1
-            index += n + 1
+        # Row n holds the n+2 coefficients of degree n+1, so split the packed array at the running sum of row lengths
+        row_ends = np.cumsum(np.arange(2, self.degree+2))
         
-        return shaped_coefficient
+        return np.split(coefficient[:row_ends[-1]], row_ends[:-1])
                 
             
 class WMM():
@@ -158,113 +184,161 @@ class WMM():
         self.reciprocal_f = 298.257223563 # 1/f, reciprocal of f
         self.f = 1.0/self.reciprocal_f
         self.e_earth = np.sqrt(self.f*(2-self.f))
-            
-    def calc_LLA2GCC(self, lat_gd, lon, h_ellp, t, degrees=False):
-        ''' Method to convert inputted geodetic latitude, longtitude, altitude into geocentric spherical coordinates,
-        which will be stored inside the self of the model
         
-        Args:
-            lat_gd (np.array): array holding the geodesic latitude associated with a state
-            lon (np.array): array holding the longtitude associated with a state
-            h_ellp (np.array): array holding the estimated heights above the ellipsoid in m
-            t (np.array): array of times associated with an array of states, given in decimal years
-            degrees (bool): kwarg, if True, converts lat_gd and lon to rads
-            
-        The geocentric spherical coordinates is saved as an np array, where the first element is the goecentric latitude,
-        the second is longitude, and the third is geocentric radius. The geodetic coorindates are also saved into
-        the model for calculation purposes. The latitude and longtitude are stored 
+        # Index tables for the vectorized field evaluation
+        self.build_tables()
+        
+        # Time adjusted Gauss coefficients of recently used decimal years, see time_coefficients
+        self.coef_cache = {}
+        self.coef_cache_size = 256
+        
+    def build_tables(self):
+        ''' Precompute the flattened (n, m) index tables used by calc_field, so that every (n, m) term of equations 10-12
+        can be evaluated for all points at once. Term k of the tables corresponds to the (n*(n+1)/2 + m - 1)th row of
+        WMMcoef.csv, for n = 1 to degree and m = 0 to n
         
-        NOTE: DO NOT USE THIS YOURSELF
+        Saved to the model:
+            n_table, m_table (np.array): degree and order of every term
+            g_table, h_table, gdot_table, hdot_table (np.array): Gauss coefficients and secular variations of every term
+            legendre_table (np.array): index n*(n+1)/2 + m of every term in the output of ssn_legendre
         '''
         
-        if degrees:
-            lat_gd *= np.pi/180.0
-            lon *= np.pi/180.0
+        self.n_table = np.concatenate([np.full(n+1, n) for n in range(1, self.degree+1)])
+        self.m_table = np.concatenate([np.arange(n+1) for n in range(1, self.degree+1)])
+        
+        self.g_table = np.concatenate(self.coef.g_)
+        self.h_table = np.concatenate(self.coef.h_)
+        self.gdot_table = np.concatenate(self.coef.gdot_)
+        self.hdot_table = np.concatenate(self.coef.hdot_)
+        
+        self.legendre_table = self.n_table*(self.n_table + 1)//2 + self.m_table
+        
+        # Factors of the sums over m in equations 10-12
+        self.m_factor = self.m_table[:, np.newaxis]
+        self.z_factor = (self.n_table + 1)[:, np.newaxis]
             
-        # Calculate radius of curvature of the prime vertical for given coordinates
-        self.R_c = self.A / (np.sqrt(1-(self.f*(2-self.f))*(np.sin(lat_gd)**2)))
+    def time_coefficients(self, t):
+        ''' Packed Gauss coefficients adjusted to the given times, using equations:
         
-        # Radius in x and y cartesian geocentric (ECEF) plane
-        p = (self.R_c + h_ellp)*np.cos(lat_gd)
+        g^m_n(t) = g^m_n(t_0) + (t-t_0) g_dot^m_n(t_0)
+        h^m_n(t) = h^m_n(t_0) + (t-t_0) h_dot^m_n(t_0)
         
-        # Calculate z cartesian geocentric (ECEF) coordinate
-        z = (self.R_c*(1-self.e_earth**2) + h_ellp)*np.sin(lat_gd)
+        The coefficients of a single decimal year are cached and reused, as a filter run asks for nearly the same time
+        over and over. Many times at once are evaluated only once per distinct time.
         
-        # Get geocentric radius from p and z
-        r = np.sqrt(p**2 + z**2)
+        Args:
+            t (float or np.array): decimal year, or array of N decimal years
+            
+        Out:
+            g_t, h_t (np.array): (K, 1) coefficients when every time is the same, otherwise (K, N), where row k belongs to
+                degree n_table[k] and order m_table[k]
+        '''
         
-        # Get geocentric latitude
-        lat_gc = np.arcsin(z/r)
+        times, inverse = np.unique(np.asarray(t, dtype=float), return_inverse=True)
+        
+        if times.shape[0] == 1:
+            key = float(times[0])
+            if key not in self.coef_cache:
+                if len(self.coef_cache) >= self.coef_cache_size:
+                    self.coef_cache.clear()
+                g_t = (self.g_table + (key - self.t_0)*self.gdot_table)[:, np.newaxis]
+                h_t = (self.h_table + (key - self.t_0)*self.hdot_table)[:, np.newaxis]
+                g_t.flags.writeable = False
+                h_t.flags.writeable = False
+                self.coef_cache[key] = (g_t, h_t)
+            return self.coef_cache[key]
+        
+        # Batched form: one column per distinct time, then expanded back to every point
+        DT = times - self.t_0
+        g_t = self.g_table[:, np.newaxis] + np.outer(self.gdot_table, DT)
+        h_t = self.h_table[:, np.newaxis] + np.outer(self.hdot_table, DT)
+        
+        return g_t[:, inverse.ravel()], h_t[:, inverse.ravel()]
+    
+    def calc_field(self, lat_gd, lon, h_ellp, t, degrees=False):
+        ''' Vectorized calculation of the magnetic field at N points, evaluating every (n, m) term of equations 10-12 for
+        all points at once instead of looping over n and m
         
-        # Store geodesic vector, geodetic vector, as well as corresponding time stamp
-        self.GDC = np.array([lat_gd, lon, h_ellp])
-        self.GCC = np.array([lat_gc, lon, r])
-        self.t = t
+        Args:
+            lat_gd (np.array): geodetic latitudes of the points
+            lon (np.array): longtitudes of the points
+            h_ellp (np.array): heights above the ellipsoid in m
+            t (np.array): times of the points, given in decimal years
+            degrees (bool): kwarg, if True, lat_gd and lon are given in degrees
+            
+        Out:
+            B_ellip (np.array): (N, 3) magnetic field vectors [X, Y, Z] in the ellipsoidal reference frame, in nT
+            B_gcc (np.array): (N, 3) geocentric magnetic field vectors [X', Y', Z'], in nT
+            lat_gc (np.array): geocentric latitudes of the points, radians
+            r (np.array): geocentric radii of the points, m
+        '''
         
-        # Calculate the array of Schmidt semi normalized associated legendre functions for given latitude and given order    
-        self.legendre = []
-        for i in np.arange(0, self.t.shape[0], 1):
-            self.legendre.append(ssn_lpmv(self.degree+1, np.sin(self.GCC[0, i])))
-            #self.legendre.append(legendre.PlmSchmidt(self.degree+1, np.sin(self.GCC[0, i])))
-        self.legendre = np.array(self.legendre)    
+        lat_gd = np.array(lat_gd, dtype=float, ndmin=1)
+        lon = np.array(lon, dtype=float, ndmin=1)
+        h_ellp = np.asarray(h_ellp, dtype=float)
+        t = np.asarray(t, dtype=float)
         
+        if degrees:
+            lat_gd *= np.pi/180.0
+            lon *= np.pi/180.0
         
-    def determine_coefficients(self):
-        '''Determine gauss coefficients for desired time using equations:
+        # Geodetic to geocentric spherical coordinates
+        sin_gd = np.sin(lat_gd)
+        R_c = self.A / np.sqrt(1 - (self.f*(2-self.f))*sin_gd**2)
+        p = (R_c + h_ellp)*np.cos(lat_gd)
+        z = (R_c*(1-self.e_earth**2) + h_ellp)*sin_gd
+        r = np.sqrt(p**2 + z**2)
+        lat_gc = np.arcsin(z/r)
         
-        g^m_n(t) = g^m_n(t_0) + (t-t_0) g_dot^m_n(t_0)
-        h^m_n(t) = h^m_n(t_0) + (t-t_0) h_dot^m_n(t_0)
+        sin_lat = np.sin(lat_gc)
+        cos_lat = np.cos(lat_gc)
+        
+        # cos(m*lon) and sin(m*lon) for m = 0 to degree, from the angle addition recurrence
+        cos_lon = np.cos(lon)
+        sin_lon = np.sin(lon)
+        cos_mlon = np.empty((self.degree+1, lon.shape[0]))
+        sin_mlon = np.empty((self.degree+1, lon.shape[0]))
+        cos_mlon[0] = 1
+        sin_mlon[0] = 0
+        for m in range(1, self.degree+1):
+            cos_mlon[m] = cos_mlon[m-1]*cos_lon - sin_mlon[m-1]*sin_lon
+            sin_mlon[m] = sin_mlon[m-1]*cos_lon + cos_mlon[m-1]*sin_lon
+            
+        # (a/r)^(n+2) for n = 1 to degree, from repeated multiplication
+        ratio = self.a / r
+        ratio_n = np.empty((self.degree+1, lon.shape[0]))
+        ratio_n[0] = ratio**2
+        for n in range(1, self.degree+1):
+            ratio_n[n] = ratio_n[n-1]*ratio
         
-        where g^m_n(t_0) and h^m_n(t_0) are the coeffients for the reference epoch, t_0 = 2020.0, of which
-        the values are stored in the file and in the WMMCoefficientLoader class. The quantities g_dot^m_n(t_0) and
-        h_dot^m_n(t_0) are the secular variation coefficients.
+        # Gauss coefficients of every term at the time of every point, (K, N) or (K, 1) if all points share a time
+        g_t, h_t = self.time_coefficients(t)
         
-        This function also calculates the array of Schmidt semi-normalized associated Legrende functions of nth
-        order and mth order, where P_m,n is stored in the ( n*(n+1)/2 + m )th index of the matrix 
+        # SSNA Legendre functions of sin(latitude) and their derivatives with respect to latitude
+        Lp, Lp_dlat = ssn_legendre(self.degree, sin_lat)
+        Lp_mn = Lp[self.legendre_table]
+        Lp_derivative = Lp_dlat[self.legendre_table]
         
-        --------------------------------------------------------------------------------------------------
-        IMPORTANT TO NOTE:
-        The way this is being done right now is quite honestly inefficient, this will be improved upon by flattening it to
-        a 1D numpy array and having a smart iterator
+        # Every term of the sums, scaled by (a/r)^(n+2)
+        cos_m = cos_mlon[self.m_table]
+        sin_m = sin_mlon[self.m_table]
+        ratio_k = ratio_n[self.n_table]
+        gh_cos = (g_t*cos_m + h_t*sin_m)*ratio_k
+        gh_sin = (g_t*sin_m - h_t*cos_m)*ratio_k
         
-        '''
+        # Equations 10-12 of the WMM 2020 Report
+        B_x = -np.sum(gh_cos*Lp_derivative, axis=0)
+        B_y = np.sum(self.m_factor*gh_sin*Lp_mn, axis=0) / cos_lat
+        B_z = -np.sum(self.z_factor*gh_cos*Lp_mn, axis=0)
         
-        # Empty lists
-        self.g_t = []
-        self.h_t = []
-        self.g_dot_t = []
-        self.h_dot_t = []
+        # Rotate to ellipsoidal reference frame
+        cos_diff = np.cos(lat_gc - lat_gd)
+        sin_diff = np.sin(lat_gc - lat_gd)
+        B_gcc = np.column_stack((B_x, B_y, B_z))
+        B_ellip = np.column_stack((B_x*cos_diff - B_z*sin_diff, B_y, B_x*sin_diff + B_z*cos_diff))
         
-        # Calculate Gauss coefficients for desired time using model coefficients set from epoch 
-        for i in range(self.degree):
+        return B_ellip, B_gcc, lat_gc, r
             
-            # Set the m number of coefficients for a given order n
-            g_coefs = np.ones((self.t.shape[0], 1)) @ [np.array([self.coef.g_[i]])]
-            h_coefs = np.ones((self.t.shape[0], 1)) @ [np.array([self.coef.h_[i]])]
-            
-            # Pull the rate of change for the m coefficients for a given order n
-            #g_coefs_dot = np.ones((self.t.shape[0], 1)) @ [np.array(self.coef.gdot_[i])]
-            #h_coefs_dot = np.ones((self.t.shape[0], 1)) @ [np.array(self.coef.hdot_[i])]
-            g_coefs_dot = np.array(self.coef.gdot_[i])
-            h_coefs_dot = np.array(self.coef.hdot_[i])
-            
-            # Take into account time dependency based on difference between given time and epoch time of the model, which is 2020.0 in decimal years
-            # Array of time difference dt = [t1, t2, t3] tensor product with g_coefs_dot.
-            # Say, if g_coefs_dot = [g1, g2], does tensor product so that
-            # dt (x) g_coefs_dot = [[t1*g1, t1*g2],
-            #                       [t2*g1, t2*g2],
-            #                       [t3*g1, t3*g2]]
-            DT = np.array(self.t-self.t_0*np.ones(self.t.shape[0]))
-            g_coefs = g_coefs + np.tensordot(DT, g_coefs_dot, axes=0)
-            h_coefs = h_coefs + np.tensordot(DT, h_coefs_dot, axes=0)
-            
-            # Append to the list 
-            self.g_t.append(g_coefs[0])
-            self.h_t.append(h_coefs[0])
-            self.g_dot_t.append(g_coefs_dot[0])
-            self.h_dot_t.append(h_coefs_dot[0])
-            
-                  
     def calc_gcc_components(self, lat, lon_gd, h_ellp, t, degrees=False):
         ''' Determine the field vector components X', Y', and Z' in geocentric coordinates, save to model
         and also output:
@@ -281,81 +355,24 @@ class WMM():
             B_gcc (np.array): geocentric magnetic field vector [X', Y', Z']
         '''
         
-        # Convert inputted geodetic latitude, longtitude, altitude coordinates into spherical geocentric coordinates
-        # of geocentric latitude, longtitude, and radius from center
-        self.calc_LLA2GCC(lat, lon_gd, h_ellp, t, degrees)
-        self.determine_coefficients()
-        
-        # Intermediate values, pulling lon, lat, r, and other values from self for better readability
-        lat = self.GCC[0]     # radians
-        lon = self.GCC[1]     # radians
-        r = self.GCC[2]       # m
-        a = self.a            # m
-        lat_gd = self.GDC[0]  # radians
-        h = self.GDC[2]       # m
-        
-        # Field vector components
-        B_x = 0               # nT
-        B_y = 0               # nT
-        B_z = 0               # nT
-        
-        # Equations 10-12 of the WMM 2020 Report, the sum over n = 1 to n = 12
-        for n in range(1, self.degree+1):
+        # Evaluate every point at once with the vectorized engine
+        B_ellip, B_gcc, lat_gc, r = self.calc_field(lat, lon_gd, h_ellp, t, degrees)
         
-            # Initialize sum term over n as 0
-            B_x_n = 0
-            B_y_n = 0
-            B_z_n = 0
-            
-            # The sum over m from m = 0 to m = n
-            for m in range(n+1):
-            
-                # Hold Gaussian coefficients in intermediate values for convenience and to not access arrays
-                # like 20 times :)
-                g_t = self.g_t[n-1][:, m] # We do n-1, but m because n is counted from 1 but m is counted from 0 for math purposes
-                h_t = self.h_t[n-1][:, m]
-
-                # SSNA Legrende function of sin(latitude) with degree being n and order being m
-                Lp_mn = self.legendre[:, int(n*(n+1)/2 + m)]                
-               
-                # SSNA Legrende function of sin(latitude) with degree being n+1 and order being m
-                Lp_mn1 = self.legendre[:, int((n+1)*(n+2)/2 + m)]
-
-                # Derivative of SSNA Legrende function with respect to latitude
-                Lp_derivative =  ( np.multiply(Lp_mn, (n+1)*np.tan(lat)) ) -  np.sqrt((n+1)**2 - m**2) * np.multiply(Lp_mn1, (1/np.cos(lat)))
-
-                # Sump up over m
-                B_x_n += np.multiply((np.multiply(g_t, np.cos(m*lon)) + np.multiply(h_t, np.sin(m*lon))), Lp_derivative)
-                B_y_n += m*np.multiply((np.multiply(g_t, np.sin(m*lon)) - np.multiply(h_t, np.cos(m*lon))), Lp_mn)
-                B_z_n += np.multiply((np.multiply(g_t, np.cos(m*lon)) + np.multiply(h_t, np.sin(m*lon))), Lp_mn)
-                
-                
-            # Multiply with factor outside sum over m
-            B_x_n *= (a/r)**(n+2)
-            B_y_n *= (a/r)**(n+2)
-            B_z_n *= (n+1)*(a/r)**(n+2)
-            
-            
-            # Add the nth instance to the total component
-            B_x += B_x_n
-            B_y += B_y_n
-            B_z += B_z_n
-        
-        # Final factors, outside of summation
-        B_x *= -1
-        B_y *= (1/np.cos(lat))
-        B_z *= -1
+        # Store geodesic vector, geodetic vector, as well as corresponding time stamp
+        lat_gd = np.array(lat, dtype=float, ndmin=1)
+        lon = np.array(lon_gd, dtype=float, ndmin=1)
+        if degrees:
+            lat_gd *= np.pi/180.0
+            lon *= np.pi/180.0
+        self.GDC = np.array([lat_gd, lon, np.broadcast_to(h_ellp, lat_gd.shape)])
+        self.GCC = np.array([lat_gc, lon, r])
+        self.t = t
         
         # Save geocentric magnetic field 
-        self.GCBfield = np.array([B_x, B_y, B_z])
-        
-        # Rotate to ellipsoidal reference frame
-        B_x_ellip = B_x * np.cos(lat - lat_gd) - B_z * np.sin(lat - lat_gd)
-        B_y_ellip = B_y
-        B_z_ellip = B_x * np.sin(lat - lat_gd) + B_z * np.cos(lat - lat_gd)
+        self.GCBfield = B_gcc.T
         
         # Save B field in elliptical reference frame
-        self.Bfield_ellip = np.array([B_x_ellip, B_y_ellip, B_z_ellip])
+        self.Bfield_ellip = B_ellip.T
      
     def permute_coordinates(self):
         ''' Function to permute coordinate arrays stored in self so that number of points is axis 0 and orthogonal
@@ -371,6 +388,189 @@ class WMM():
         ''' Function to return the B field components in the ellipsoidal reference frame '''
         return self.Bfield_ellip
        
+class WMMGrid():
+    ''' Optional field provider that samples a WMM model once, for a single epoch, on a regular grid of geodetic latitude,
+    longtitude and height, and answers field queries by interpolating the grid instead of evaluating the spherical harmonic
+    sums. The grid is stored as float32 and can be saved to disk and memory mapped back, so that a flight computer only
+    has to build it once
+    
+    The interpolation error is measured against the full model at random check points when the grid is built, and is
+    saved with the grid as self.error (nT) and self.error_relative
+    
+    Usage:
+        grid = WMMGrid(WMM(12, 'WMMcoef.csv'), 2024.1)
+        grid.save('wmm_grid_2024')
+        grid = WMMGrid.load('wmm_grid_2024')
+        B = grid.calc_field(lat, lon, h) # (N, 3) field in nT, lat and lon in degrees, h in m
+    '''
+    
+    # Node offsets of every interpolation method, and the matrix turning powers [1, f, f^2, ...] of the fractional position
+    # f into the weights of those nodes (linear, and Lagrange cubic through the nodes at -1, 0, 1, 2)
+    stencils = {
+        'linear': (np.arange(0, 2), np.array([[1.0, 0.0],
+                                               [-1.0, 1.0]])),
+        'cubic': (np.arange(-1, 3), np.array([[0.0, 1.0, 0.0, 0.0],
+                                               [-1/3, -1/2, 1.0, -1/6],
+                                               [1/2, -1.0, 1/2, 0.0],
+                                               [-1/6, 1/2, -1/2, 1/6]])),
+    }
+    
+    def __init__(self, model, t, lat_step=1.0, lon_step=1.0, height_range=(0.0, 1000e3), height_step=50e3, method='cubic',
+                 check_points=2000):
+        ''' Sample model on the grid
+        
+        Args:
+            model (WMM): model to sample
+            t (float): decimal year the grid is built for
+            lat_step, lon_step (float): grid spacing in degrees
+            height_range (tuple): lowest and highest height above the ellipsoid covered by the grid, in m
+            height_step (float): grid spacing in height, in m
+            method (str): 'linear' for trilinear or 'cubic' for tricubic (Lagrange) interpolation
+            check_points (int): number of random points used to measure the interpolation error
+        '''
+        
+        self.t = t
+        self.method = method
+        self.lat = np.arange(-90.0, 90.0 + lat_step/2, lat_step)
+        self.lon = np.arange(-180.0, 180.0 - lon_step/2, lon_step)
+        self.heights = np.arange(height_range[0], height_range[1] + height_step/2, height_step)
+        
+        # Geodetic latitude and longtitude of every node, (lat, lon, height) ordering. The poles are moved slightly
+        # inwards, as the model divides by cos(latitude)
+        lat_nodes = np.clip(self.lat, -90.0 + 1e-6, 90.0 - 1e-6)
+        LAT, LON, H = np.meshgrid(lat_nodes, self.lon, self.heights, indexing='ij')
+        LAT, LON, H = LAT.ravel(), LON.ravel(), H.ravel()
+        
+        # Sample in chunks, to keep the (terms x points) arrays of calc_field small
+        field = np.empty((LAT.shape[0], 3), dtype=np.float32)
+        chunk = 20000
+        for start in range(0, LAT.shape[0], chunk):
+            field[start:start + chunk] = model.calc_field(LAT[start:start + chunk], LON[start:start + chunk],
+                                                          H[start:start + chunk], t, degrees=True)[0]
+        self.field = field.reshape(self.lat.shape[0], self.lon.shape[0], self.heights.shape[0], 3)
+        
+        self.error, self.error_relative = self.check_error(model, check_points)
+        
+    @classmethod
+    def load(cls, file_name, method=None):
+        ''' Load a grid written by save, memory mapping the field instead of reading it
+        
+        Args:
+            file_name (str): path the grid was saved to, without extension
+            method (str): kwarg, interpolation method to use instead of the saved one
+            
+        Out:
+            grid (WMMGrid): loaded grid
+        '''
+        
+        grid = cls.__new__(cls)
+        
+        with np.load(file_name + '_axes.npz') as axes:
+            grid.lat = axes['lat']
+            grid.lon = axes['lon']
+            grid.heights = axes['heights']
+            grid.t = float(axes['t'])
+            grid.method = str(axes['method']) if method is None else method
+            grid.error = float(axes['error'])
+            grid.error_relative = float(axes['error_relative'])
+        
+        grid.field = np.load(file_name + '.npy', mmap_mode='r')
+        
+        return grid
+    
+    def save(self, file_name):
+        ''' Save the grid as file_name.npy (float32 field) and file_name_axes.npz (grid axes, epoch and error)
+        
+        Args:
+            file_name (str): path to save to, without extension
+        '''
+        
+        np.save(file_name + '.npy', self.field)
+        np.savez(file_name + '_axes.npz', lat=self.lat, lon=self.lon, heights=self.heights, t=self.t, method=self.method,
+                 error=self.error, error_relative=self.error_relative)
+        
+    def stencil(self, x, nodes, periodic=False):
+        ''' Indices and weights of the nodes used to interpolate along one axis of a regular grid
+        
+        Args:
+            x (np.array): coordinates of the N query points along the axis
+            nodes (np.array): regularly spaced grid coordinates of the axis
+            periodic (bool): kwarg, if True the axis wraps around (longtitude), otherwise queries are clamped to the grid
+            
+        Out:
+            index (np.array): (N, 2) or (N, 4) grid indices
+            weights (np.array): weights of those nodes, same size as index
+        '''
+        
+        offsets, weight_matrix = self.stencils[self.method]
+        
+        step = nodes[1] - nodes[0]
+        position = (x - nodes[0]) / step
+        if not periodic:
+            position = np.clip(position, 0, nodes.shape[0] - 1)
+        base = np.floor(position)
+        
+        # Keep the stencil inside the grid on axes that do not wrap around
+        if not periodic:
+            base = np.clip(base, -offsets[0], nodes.shape[0] - 1 - offsets[-1])
+        f = position - base
+        
+        weights = np.power(f[:, np.newaxis], np.arange(offsets.shape[0])) @ weight_matrix
+        
+        index = base.astype(int)[:, np.newaxis] + offsets
+        if periodic:
+            index %= nodes.shape[0]
+            
+        return index, weights
+    
+    def calc_field(self, lat_gd, lon, h_ellp):
+        ''' Interpolate the field at N points
+        
+        Args:
+            lat_gd (np.array): geodetic latitudes of the points, degrees
+            lon (np.array): longtitudes of the points, degrees
+            h_ellp (np.array): heights above the ellipsoid, m
+            
+        Out:
+            B_ellip (np.array): (N, 3) magnetic field vectors [X, Y, Z] in the ellipsoidal reference frame, in nT
+        '''
+        
+        lat_gd, lon, h_ellp = np.broadcast_arrays(np.array(lat_gd, dtype=float, ndmin=1), np.array(lon, dtype=float, ndmin=1),
+                                                  np.array(h_ellp, dtype=float, ndmin=1))
+        
+        i, w_i = self.stencil(lat_gd, self.lat)
+        j, w_j = self.stencil(lon, self.lon, periodic=True)
+        k, w_k = self.stencil(h_ellp, self.heights)
+        
+        # (N, s, s, s, 3) block of nodes around every point, summed with the product of the axis weights
+        nodes = self.field[i[:, :, np.newaxis, np.newaxis], j[:, np.newaxis, :, np.newaxis], k[:, np.newaxis, np.newaxis, :]]
+        
+        return np.einsum('na,nb,nc,nabcd->nd', w_i, w_j, w_k, nodes)
+    
+    def check_error(self, model, points=2000, seed=0):
+        ''' Measure the interpolation error against the full model at random points inside the grid
+        
+        Args:
+            model (WMM): model the grid was sampled from
+            points (int): number of random points to check
+            seed (int): seed of the random points
+            
+        Out:
+            error (float): largest norm of the difference between interpolated and model field, nT
+            error_relative (float): largest ratio of that difference to the norm of the model field
+        '''
+        
+        rng = np.random.default_rng(seed)
+        lat = rng.uniform(-89.0, 89.0, points)
+        lon = rng.uniform(-180.0, 180.0, points)
+        h = rng.uniform(self.heights[0], self.heights[-1], points)
+        
+        B_model = model.calc_field(lat, lon, h, self.t, degrees=True)[0]
+        difference = np.linalg.norm(self.calc_field(lat, lon, h) - B_model, axis=1)
+        
+        return difference.max(), (difference / np.linalg.norm(B_model, axis=1)).max()
+        
+       
 # Testing WMM model
 if __name__ == "__main__":
     
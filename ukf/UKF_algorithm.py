@@ -31,11 +31,49 @@ import math
 import bigEOMS
 import scipy
 import scipy.linalg
+import scipy.linalg.lapack
 from hfunc import *
 from typing import Optional
 
 
-def sigma(means, cov, n, scaling):
+def choleskyFactor(cov):
+    '''
+    choleskyFactor
+        finds upper triangular matrix square root U of cov (cov = U^T * U) using a cholesky factorization
+        if cov has drifted away from positive definite, it is repaired by symmetrizing, clipping its eigenvalues
+        to a small positive floor, and adding increasing jitter to the diagonal until the factorization succeeds
+
+    @params
+        cov: symmetric covariance matrix to factor (n x n)
+
+    @returns
+        factor: upper triangular matrix whose rows sum in outer product to cov (n x n)
+    '''
+    try:
+        # numpy returns lower triangular L with cov = L * L^T, so its transpose is our upper factor
+        return np.linalg.cholesky(cov).T
+    except np.linalg.LinAlgError:
+        pass
+
+    # force symmetry, then clip negative or zero eigenvalues to a floor relative to the largest one
+    sym = (cov + cov.T) / 2
+    vals, vecs = np.linalg.eigh(sym)
+    floor = np.finfo(float).eps * max(np.abs(vals).max(), np.finfo(float).tiny)
+    vals = np.maximum(vals, floor)
+    repaired = np.matmul(vecs * vals, vecs.T)
+
+    # add jitter to the diagonal, growing by an order of magnitude until the factorization succeeds
+    jitter = floor
+    for i in range(10):
+        try:
+            return np.linalg.cholesky(repaired + jitter * np.identity(len(cov))).T
+        except np.linalg.LinAlgError:
+            jitter *= 10
+
+    raise np.linalg.LinAlgError("covariance matrix could not be repaired to positive definite")
+
+
+def sigma(means, cov, n, scaling, out=None):
     '''
     sigma
         creates sigma point matrix that is a representative sampling of the mean and covariance of the system (eq 5-7)
@@ -46,26 +84,26 @@ def sigma(means, cov, n, scaling):
         cov: covariance matrix of state (n x n)
         n: dimensionality of model
         scaling: how far from mean we distribute our points, used in sigma point formula
+        out: optional buffer to write sigma points into (2 * n + 1, n)
 
     @returns
         sigmaMatrix: matrix of sigma points (2 * n + 1, n) 
     '''
-    # intialize 2N + 1 sigma points to zeroes
-    sigmaMatrix = np.zeros((2*n+1,n))
-    temp = np.zeros((n, n))
+    # intialize 2N + 1 sigma points to zeroes, unless caller gave us a buffer to fill
+    sigmaMatrix = np.zeros((2*n+1,n)) if out is None else out
 
     # 1) sigma point generation
     # first column of sigma matrix is means
     sigmaMatrix[0] = means
 
-    # take the square root of the inside
-    temp = scipy.linalg.sqrtm(np.multiply(cov, (n + scaling)))
+    # take the square root of the inside using a cholesky factor (repaired if no longer positive definite)
+    temp = choleskyFactor(np.multiply(cov, (n + scaling)))
 
     # traverse n dimensions, calculating all other sigma points
     # means + sqrt for 1 to n
-    sigmaMatrix[1:(n+1)] = np.add(means, temp)
+    np.add(means, temp, out=sigmaMatrix[1:(n+1)])
     # means - sqrt for n + 1 to 2*n
-    sigmaMatrix[(n+1):(2*n+1)] = np.subtract(means, temp)
+    np.subtract(means, temp, out=sigmaMatrix[(n+1):(2*n+1)])
 
     # return the sigma matrix (2 * n + 1 columns)
     return sigmaMatrix
@@ -103,6 +141,18 @@ class TEST1EOMS():
         for i in np.arange(self.rw_config.shape[1]):
             self.I_body = self.I_body + I_w_trans*(np.identity(3) - np.matmul(self.rw_config[:, i], np.transpose(self.rw_config[:, i]))) 
 
+        # Inertia tensor is constant once reaction wheel contributions are added, so invert it once here
+        self.I_body_inv = np.linalg.inv(self.I_body)
+
+        # Transposes so that row vectors of w_sat can be multiplied directly in eoms_batch
+        self.I_body_T = np.ascontiguousarray(self.I_body.T)
+        self.I_body_inv_T = np.ascontiguousarray(self.I_body_inv.T)
+
+        # Reaction wheel momentum and torque vectors for eoms_batch, which are the same size for any number of rows
+        self.H_B_w = np.zeros(3)
+        self.H_B_w_dot = np.zeros(3)
+        self.torque = np.zeros(3)
+
     def eoms(self, quaternion: np.ndarray, w_sat: np.ndarray, w_rw: np.ndarray, tau_sat: np.ndarray, alpha_rw: np.ndarray, dt: float):
         ''' Function constructing the equations of motion / state-space equations to yield the first derivative of quaternion w and angular velocity of 
         body + wheels w_sat, given current state + external torques
@@ -148,7 +198,7 @@ class TEST1EOMS():
         quaternion_dot = (1/2) * np.matmul(w_sat_skew_mat, quaternion)        
 
         # First derivative of angular velocity
-        w_sat_dot = np.matmul(np.linalg.inv(self.I_body), (tau_sat - H_B_w_dot - np.cross(w_sat, np.matmul(self.I_body, w_sat) + H_B_w)))
+        w_sat_dot = np.matmul(self.I_body_inv, (tau_sat - H_B_w_dot - np.cross(w_sat, np.matmul(self.I_body, w_sat) + H_B_w)))
 
         # First derivative of rw speeds = angular acceleration of wheels
         w_rw_dot = alpha_rw
@@ -161,6 +211,132 @@ class TEST1EOMS():
 
         return new_state
 
+    def eoms_batch(self, states: np.ndarray, w_rw: np.ndarray, tau_sat: np.ndarray, alpha_rw: np.ndarray, dt: float, out=None, work=None):
+        ''' Batched version of eoms that propagates every row of a state matrix (such as the sigma point matrix) at once
+        using the same dynamics, without building the Omega matrix or inverting I_body for each row.
+        Allocates no new arrays if out and work are given
+
+        Args:
+            states (np.ndarray, (N x 7)): rows of [quaternion, w_sat] to propagate
+            w_rw (np.ndarray, (1x3) for 1D test only): angular velocities of wheels (in respective wheel frame)
+            tau_sat (np.ndarray, (1x3)): external and internal torque applied on the satellite, such as magnetorquers
+            alpha_rw (nd.ndarray, (1x3)): angular acceleration of the reaction wheels in their respective wheel frames
+            dt (float)
+            out (np.ndarray, (N x 7)): optional buffer to write propagated rows into, must not overlap states
+            work (np.ndarray, (4 x N x 3)): optional scratch buffer
+        Out:
+            new_states (np.ndarray, (N x 7)): propagated rows of [quaternion, w_sat]
+        '''
+        rows = states.shape[0]
+        if out is None:
+            out = np.empty((rows, 7))
+        if work is None:
+            work = np.empty((4, rows, 3))
+
+        quaternion = states[:, :4]
+        w_sat = states[:, 4:7]
+        q0 = quaternion[:, 0]
+        q1 = quaternion[:, 1]
+        q2 = quaternion[:, 2]
+        q3 = quaternion[:, 3]
+        w_x = w_sat[:, 0]
+        w_y = w_sat[:, 1]
+        w_z = w_sat[:, 2]
+
+        # I_body * w_sat + H_B_w, torque on every row, and w_sat_dot, as row vectors
+        momentum = work[0]
+        torque = work[1]
+        w_sat_dot = work[2]
+        temp = work[3, :, 0]
+
+        # Construct vectors describing reaction wheel angular momentum and torque in the body frame, shared by every row
+        np.matmul(self.rw_config, w_rw, out=self.H_B_w)
+        self.H_B_w *= self.I_w_spin
+        np.matmul(self.rw_config, alpha_rw, out=self.H_B_w_dot)
+        self.H_B_w_dot *= self.I_w_spin
+
+        # Add propagation of the quaternion, quaternion + dt * (1/2) * big omega * quaternion (see eoms), one component at a time
+        half_dt = dt / 2
+        # q0 + (dt/2) * (-w_x*q1 - w_y*q2 - w_z*q3)
+        out[:, 0] = q0
+        addProduct(out[:, 0], w_x, q1, -half_dt, temp)
+        addProduct(out[:, 0], w_y, q2, -half_dt, temp)
+        addProduct(out[:, 0], w_z, q3, -half_dt, temp)
+        # q1 + (dt/2) * (w_x*q0 + w_z*q2 - w_y*q3)
+        out[:, 1] = q1
+        addProduct(out[:, 1], w_x, q0, half_dt, temp)
+        addProduct(out[:, 1], w_z, q2, half_dt, temp)
+        addProduct(out[:, 1], w_y, q3, -half_dt, temp)
+        # q2 + (dt/2) * (w_y*q0 - w_z*q1 + w_x*q3)
+        out[:, 2] = q2
+        addProduct(out[:, 2], w_y, q0, half_dt, temp)
+        addProduct(out[:, 2], w_z, q1, -half_dt, temp)
+        addProduct(out[:, 2], w_x, q3, half_dt, temp)
+        # q3 + (dt/2) * (w_z*q0 + w_y*q1 - w_x*q2)
+        out[:, 3] = q3
+        addProduct(out[:, 3], w_z, q0, half_dt, temp)
+        addProduct(out[:, 3], w_y, q1, half_dt, temp)
+        addProduct(out[:, 3], w_x, q2, -half_dt, temp)
+
+        # Angular momentum of every row, I_body * w_sat + H_B_w, using row vectors so that I * w becomes w * I^T
+        np.matmul(w_sat, self.I_body_T, out=momentum)
+        momentum += self.H_B_w
+
+        # tau_sat - H_B_w_dot - cross(w_sat, momentum), one component at a time
+        np.subtract(tau_sat, self.H_B_w_dot, out=self.torque)
+        torque[:] = self.torque
+        # cross x: w_y*m_z - w_z*m_y
+        addProduct(torque[:, 0], w_y, momentum[:, 2], -1, temp)
+        addProduct(torque[:, 0], w_z, momentum[:, 1], 1, temp)
+        # cross y: w_z*m_x - w_x*m_z
+        addProduct(torque[:, 1], w_z, momentum[:, 0], -1, temp)
+        addProduct(torque[:, 1], w_x, momentum[:, 2], 1, temp)
+        # cross z: w_x*m_y - w_y*m_x
+        addProduct(torque[:, 2], w_x, momentum[:, 1], -1, temp)
+        addProduct(torque[:, 2], w_y, momentum[:, 0], 1, temp)
+
+        # First derivative of angular velocity, I^-1 * torque, and propagation
+        np.matmul(torque, self.I_body_inv_T, out=w_sat_dot)
+        np.multiply(w_sat_dot, dt, out=out[:, 4:7])
+        out[:, 4:7] += w_sat
+
+        return out
+
+
+def addProduct(column, a, b, scale, temp):
+    '''
+    addProduct
+        adds scale * a * b to column in place, for the per-row products of eoms_batch
+
+    @params
+        column: array to add to (N)
+        a, b: factors of the product (N)
+        scale: scalar multiplying the product
+        temp: scratch array (N)
+    '''
+    np.multiply(a, b, out=temp)
+    temp *= scale
+    column += temp
+
+
+def createEOMS():
+    '''
+    createEOMS
+        builds the 1D test EOMs using the measured inertia constants of our cubeSat
+
+    @returns
+        EOMS: TEST1EOMS instance with inertia tensor already adjusted and inverted
+    '''
+    # intertia constants from juwan
+    I_body = np.array([[46535.388, 257.834, 536.12],
+              [257.834, 47934.771, -710.058],
+              [536.12, -710.058, 23138.181]])
+    I_body = I_body * 1e-7
+    I_spin = 5.1e-7
+    I_trans = 0
+
+    return TEST1EOMS(I_body, I_spin, I_trans)
+
 
 def quaternionMultiply(a, b):
     '''
@@ -186,7 +362,7 @@ def generatePredMeans(eomsClass, sigmaPoints, w0, w1, reaction_speeds, old_react
         also stores and returns all transformed sigma points
             
     @params
-        eomsClass: EOMs class to pass our sigma points through
+        eomsClass: EOMs class to pass our sigma points through (must implement eoms_batch)
         sigmaPoints: sigma point matrix (2xn+1 x n)
         w0, w1: weight for first and all other sigma points, respectively
         reaction_speeds/old_reaction_speeds: reaction wheel speeds for current and last time step (1 x 3 for 1d test)
@@ -196,36 +372,16 @@ def generatePredMeans(eomsClass, sigmaPoints, w0, w1, reaction_speeds, old_react
         means: mean of distribution in state or measurement space (1 x n or 1 x m)
         transformedSigma: sigma matrix of transformed points (n*2+1 x n or n*2+1 x m)
     '''
-    # initialize means and new sigma matrix with correct dimensionality
-    means = np.zeros(n)
-    transformedSigma = np.zeros((2 * n + 1, n))
-
     # CHANGE TO PASS TO FUNCITON THROUGHOUT??
     dt = 0.1
     # calculate angular acceleration using old and current reaction wheel speeds
     alpha = (reaction_speeds - old_reaction_speeds) / dt
 
-    # pass all sigma points to the transformation function
-    for i in range(1, n * 2 + 1):
-        # 3a) and 4a)
-        x = eomsClass.eoms(sigmaPoints[i][:4], sigmaPoints[i][4:], reaction_speeds, 0, alpha, dt)
-
-        # store calculated sigma point in transformed sigma matrix
-        transformedSigma[i] = x
-        # update mean with point
-        means = np.add(means, x)
-
-    # apply weight to mean without first point
-    means *= w1
-
-    # pass first sigma point through transformation function
-    x = eomsClass.eoms(sigmaPoints[0][:4], sigmaPoints[0][4:], reaction_speeds, 0, alpha, dt)
-    
-    # store new point as first element in transformed sigma matrix
-    transformedSigma[0] = x
+    # 3a) and 4a): pass all sigma points through the EOMs at once
+    transformedSigma = eomsClass.eoms_batch(sigmaPoints, reaction_speeds, 0, alpha, dt)
 
-    # adjust the means for first value and multiply by correct weight
-    means = np.add(means, x*w0)
+    # weighted sum of transformed points, using first weight for first point and other weight for the rest
+    means = w1 * np.sum(transformedSigma[1:], axis=0) + w0 * transformedSigma[0]
 
     return means, transformedSigma
 
@@ -276,10 +432,11 @@ def generateMesMeans(func, controlVector, sigmaPoints, w0, w1, n, dimensionality
     return means, transformedSigma
 
 
-def generateCov(means, transformedSigma, w0, w1, n, noise):
+def generateCov(means, transformedSigma, w0, w1, n, noise, out=None):
     '''
     generateCov
         generates covariance matrix from eq 10 and 13 based on means and sigma points
+        all sigma points are handled at once by weighting the matrix of deviations from the mean
         
     @params
         means: means in state or measurement space (1 x n or 1 x m)
@@ -287,44 +444,32 @@ def generateCov(means, transformedSigma, w0, w1, n, noise):
         w0, w1: weight for first and all other sigma points, respectively
         n: dimensionality of model 
         noise: noise value array to apply to our cov matrix (r or q)
+        out: optional buffer to write covariance into (n x n or m x m)
         
     @returns
         cov: covariance matrix in state or measurement space (n x n or m x m)
     '''
-    # find dimension of cov by looking at size of sigma point array
-    # prediction points will have n columns, measurement points will have m columns
-    covDimension = transformedSigma.shape[1]
-    
-    # initialize cov with proper dimensionality
-    cov = np.zeros((covDimension, covDimension))
+    # subtract mean from every sigma point (n*2+1 x n or n*2+1 x m)
+    deviations = np.subtract(transformedSigma, means)
 
-    # for all transformed sigma points, apply covariance formula
-    for i in range(1, n * 2 + 1):
-        # subtract mean from sigma point and multiply by itself transposed
-        arr = np.subtract(transformedSigma[i], means)[np.newaxis]
-        arr = np.matmul(arr.transpose(), arr)
-        cov = np.add(cov, arr)
-    
-    # separate out first value and update with correct weight
-    arr = np.subtract(transformedSigma[0], means)[np.newaxis]
-    d = np.matmul(arr.transpose(), arr) * w0
-
-    # use other weight for remaining values
-    cov *= w1
+    # weight vector for sigma points: first weight for first point, other weight for all remaining points
+    weights = np.full(2 * n + 1, w1)
+    weights[0] = w0
 
-    # add back first element
-    cov = np.add(cov, d)
+    # sum of weighted outer products of every deviation with itself, as a single matrix product
+    cov = np.matmul(deviations.T * weights, deviations, out=out)
 
     # add noise to covariance matrix
-    cov = np.add(cov, noise)
+    cov += noise
 
     return cov
 
 
-def generateCrossCov(predMeans, mesMeans, f, h, w0, w1, n):
+def generateCrossCov(predMeans, mesMeans, f, h, w0, w1, n, out=None):
     '''
     generateCrossCov
         use equation 14 to generate cross covariance between our means and sigma points in our state and measurement space
+        all sigma points are handled at once by weighting the matrices of deviations from the means
 
     @params
         predMeans: predicted means based on EOMs (1 x n)
@@ -334,31 +479,21 @@ def generateCrossCov(predMeans, mesMeans, f, h, w0, w1, n):
         w0: weight for first value
         w1: weight for other values
         n: dimensionality of model
+        out: optional buffer to write cross covariance into (n x m)
     
     @returns
         crossCov: represents uncertainty between our state and measurement space estimates (n x m)
     '''
-    m = len(mesMeans)
-    crossCov = np.zeros((n,m))
-
-    for i in range(1, n * 2 + 1):
-        arr1 = np.subtract(f[i], predMeans)[np.newaxis]
-        arr2 = np.subtract(h[i], mesMeans)[np.newaxis]
-        arr1 = np.matmul(arr1.transpose(), arr2)  # ordering?
-        crossCov = np.add(crossCov, arr1)
-
-    arr1 = np.subtract(f[0], predMeans)[np.newaxis]
-    arr2 = np.subtract(h[0], mesMeans)[np.newaxis]
+    # deviations of every sigma point from the means in state and measurement space
+    predDeviations = np.subtract(f, predMeans)
+    mesDeviations = np.subtract(h, mesMeans)
 
-    # seperate out first element
-    d = np.matmul(arr1.transpose(), arr2)
+    # weight vector for sigma points: first weight for first point, other weight for all remaining points
+    weights = np.full(2 * n + 1, w1)
+    weights[0] = w0
 
-    # multiply by weights for first and other values
-    crossCov = np.multiply(crossCov, w1)
-    d = np.multiply(d, w0)
-
-    # add first value back into cross covariance
-    crossCov = np.add(crossCov, d)
+    # sum of weighted outer products between state and measurement deviations, as a single matrix product
+    crossCov = np.matmul(predDeviations.T * weights, mesDeviations, out=out)
 
     return crossCov
 
@@ -410,15 +545,8 @@ def UKF(means, cov, q, r, gps_data, reaction_speeds, old_reaction_speeds, data):
 
 
     # prediction step
-    # intertia constants from juwan
-    I_body = np.array([[46535.388, 257.834, 536.12],
-              [257.834, 47934.771, -710.058],
-              [536.12, -710.058, 23138.181]])
-    I_body = I_body * 1e-7
-    I_spin = 5.1e-7
-    I_trans = 0
     # intialize 1D EOMs using intertia measurements of cubeSat
-    EOMS = TEST1EOMS(I_body, I_spin, I_trans)
+    EOMS = createEOMS()
     
     # eq 8-9: pass sigma points through EOMs (f) and generate mean in state space
     predMeans, f = generatePredMeans(EOMS, sigmaPoints, w0_m, w1, reaction_speeds, old_reaction_speeds, n)
@@ -476,3 +604,542 @@ def UKF(means, cov, q, r, gps_data, reaction_speeds, old_reaction_speeds, data):
     # print("MEANS AT END: ", means)
     # print("COV AT END: ", cov)
     return [means, cov]
+
+
+def cholUpdate(factor, x, sign):
+    '''
+    cholUpdate
+        rank-1 cholesky update or downdate of an upper triangular factor
+        given factor U with P = U^T * U, finds the upper triangular factor of P + x * x^T (update) or P - x * x^T (downdate)
+        without ever forming or refactoring P, costing O(n^2) instead of O(n^3)
+
+    @params
+        factor: upper triangular cholesky factor with positive diagonal (n x n), modified in place
+        x: vector to add or remove from the factored matrix (1 x n), not modified
+        sign: 1 for an update, -1 for a downdate
+
+    @returns
+        factor: updated upper triangular factor (n x n)
+    '''
+    x = np.array(x, dtype=float)
+    n = len(x)
+
+    for k in range(n):
+        # new diagonal element. A downdate that removes more than is there leaves the matrix indefinite
+        rSquared = factor[k, k] * factor[k, k] + sign * x[k] * x[k]
+        if rSquared <= 0:
+            raise np.linalg.LinAlgError("cholesky downdate made matrix no longer positive definite")
+        r = np.sqrt(rSquared)
+
+        # givens-like rotation parameters that zero out x[k] against the diagonal
+        c = r / factor[k, k]
+        s = x[k] / factor[k, k]
+        factor[k, k] = r
+
+        # apply rotation to the rest of row k and the remaining part of x
+        factor[k, k+1:] = (factor[k, k+1:] + sign * s * x[k+1:]) / c
+        x[k+1:] = c * x[k+1:] - s * factor[k, k+1:]
+
+    return factor
+
+
+def qrFactor(stacked):
+    '''
+    qrFactor
+        finds upper triangular factor U with U^T * U = stacked^T * stacked using a QR decomposition,
+        so the sum of outer products of all rows of stacked is never formed or factored directly
+
+    @params
+        stacked: matrix whose rows are the weighted vectors to combine (k x n, k >= n)
+
+    @returns
+        factor: upper triangular factor with positive diagonal (n x n)
+    '''
+    factor = np.linalg.qr(stacked, mode='r')
+
+    # QR only defines each row up to sign, so flip rows to keep a positive diagonal for cholUpdate
+    signs = np.sign(np.diag(factor))
+    signs[signs == 0] = 1
+
+    return factor * signs[:, np.newaxis]
+
+
+def generateSqrtCov(deviations, w0, w1, noiseSqrt):
+    '''
+    generateSqrtCov
+        square root form of generateCov (eq 10 and 13): finds upper triangular factor of the weighted covariance of
+        transformed sigma points plus noise, with a single QR decomposition.
+        w0 is negative for small alpha, so the first point cannot be stacked with the others as sqrt(w0) * deviation.
+        Instead every other point is taken relative to the first, which (as the means use weight w1 for the same points)
+        leaves the first point with weight w0 + 2n * w1 - 2 = beta - alpha^2, positive for the usual beta = 2.
+        Only if that weight is negative is the first point removed with a rank-1 downdate
+
+    @params
+        deviations: transformed sigma points minus their mean (n*2+1 x n or n*2+1 x m)
+        w0, w1: covariance weight for first and all other sigma points, respectively
+        noiseSqrt: matrix whose rows sum in outer product to the noise covariance (q or r), such as its cholesky factor
+
+    @returns
+        factor: upper triangular factor of covariance in state or measurement space (n x n or m x m)
+    '''
+    # weight of the first point once the others are taken relative to it
+    firstWeight = w0 + (len(deviations) - 1) * w1 - 2
+
+    # every point except the first shares weight w1, so stack sqrt(w1) * (deviations - first deviation) on top of the noise factor
+    stacked = [np.sqrt(w1) * np.subtract(deviations[1:], deviations[0]), noiseSqrt]
+    if firstWeight >= 0:
+        stacked.append(np.sqrt(firstWeight) * deviations[0:1])
+        return qrFactor(np.vstack(stacked))
+
+    return cholUpdate(qrFactor(np.vstack(stacked)), np.sqrt(-firstWeight) * deviations[0], -1)
+
+
+def SRUKF(means, sqrtCov, sqrtQ, sqrtR, gps_data, reaction_speeds, old_reaction_speeds, data):
+    '''
+    SRUKF
+        square root form of UKF: estimates state at time step based on sensor data, noise, and equations of motion,
+        but carries the upper triangular cholesky factor of the covariance between steps instead of the covariance itself
+        (Wan and van der Merwe, section 7.3). The factor is updated with QR and rank-1 cholesky downdates, so the
+        covariance is never factored again and stays positive definite over long runs. If rounding makes a downdate
+        indefinite, the factor is rebuilt with QR from the sigma point deviations instead
+
+    @params
+        means: means of previous states (1 x n)
+        sqrtCov: upper triangular cholesky factor of state covariance, cov = sqrtCov^T * sqrtCov (n x n)
+            (choleskyFactor(cov) gives this for the starting covariance)
+        sqrtQ: upper triangular cholesky factor of process noise covariance matrix (n x n)
+        sqrtR: upper triangular cholesky factor of measurement noise covariance matrix (m x m)
+        gps_data: control input vector for hfunc (gps data: longitude, latitude, height, time)
+        reaction_speeds: control input for EOMs (1 x 4)
+        old_reaction_speeds: speeds for past step, used to find angular acceleration (1 x 4)
+        data: magnetometer (magnetic field) and gyroscope (angular velocity) data reading from sensor (1 x m)
+
+    @returns
+        means: calculated state estimate at current time (1 x n)
+        sqrtCov: upper triangular cholesky factor of covariance matrix (n x n)
+    '''
+
+    # dimensionality of state space = dimension of means
+    n = len(means)
+    # dimensionality of measurement space = dimension of measurement noise
+    m = len(sqrtR)
+
+    # scaling parameters, same as UKF
+    alpha = 0.001
+    k = 0
+    beta = 2
+    # eq 1: scaling factor lambda
+    scaling = alpha * alpha * (n + k) - n
+
+    # eq 2-4: weights calculation
+    w0_m = scaling / (n + scaling) # weight for first value for means
+    w0_c = scaling / (n + scaling) + (1 - alpha * alpha + beta) # weight for first value for covariance
+    w1 = 1 / (2 * (n + scaling)) # weight for all other values
+
+
+    # eq 5-7: sigma point generation, using the carried factor directly as the matrix square root
+    sigmaPoints = np.zeros((2*n+1, n))
+    sigmaPoints[0] = means
+    spread = np.sqrt(n + scaling) * sqrtCov
+    sigmaPoints[1:(n+1)] = np.add(means, spread)
+    sigmaPoints[(n+1):(2*n+1)] = np.subtract(means, spread)
+
+
+    # prediction step
+    # intialize 1D EOMs using intertia measurements of cubeSat
+    EOMS = createEOMS()
+
+    # eq 8-9: pass sigma points through EOMs (f) and generate mean in state space
+    predMeans, f = generatePredMeans(EOMS, sigmaPoints, w0_m, w1, reaction_speeds, old_reaction_speeds, n)
+
+    # eq 10: factor of predicted covariance + process noise q
+    predDeviations = np.subtract(f, predMeans)
+    predSqrtCov = generateSqrtCov(predDeviations, w0_c, w1, sqrtQ)
+
+
+    if len(gps_data) == 4:
+        # finds true B field based on gps data
+        Bfield = bfield_calc(gps_data)
+    else: 
+        # for ideal tests only, use gps_data as b field vector and skip calculating it from the gps data
+        Bfield = gps_data
+
+    # eq 11-12: non linear transformation of predicted sigma points f into measurement space (h), and mean generation
+    mesMeans, h = generateMesMeans(hfunc, Bfield, f, w0_m, w1, n, m)
+
+    # eq 13: factor of measurement covariance + measurement noise r
+    mesSqrtCov = generateSqrtCov(np.subtract(h, mesMeans), w0_c, w1, sqrtR)
+
+
+    # measurement updates
+    # eq 14: cross covariance. compare our different sets of sigma points and our predicted/measurement means
+    crossCov = generateCrossCov(predMeans, mesMeans, f, h, w0_c, w1, n)
+
+    # eq 15: kalman gain = crossCov * (mesSqrtCov^T * mesSqrtCov)^-1, found with two triangular solves instead of an inverse
+    kalman = scipy.linalg.solve_triangular(mesSqrtCov, scipy.linalg.solve_triangular(mesSqrtCov, crossCov.transpose(), trans='T'))
+    kalman = kalman.transpose()
+
+    # eq 16: updated final mean = predicted + kalman(measurement data - predicted means in measurement space)
+    means = np.add(predMeans, np.matmul(kalman, np.subtract(data, mesMeans)))
+
+    # normalize the quaternion to reduce small calculation errors over time
+    means[0:4] = means[0:4]/np.linalg.norm(means[0:4])
+
+    # eq 17: cov = predCov - kalman * mesCov * kalman^T, which in factored form is a downdate of predSqrtCov
+    # by every column of kalman * mesSqrtCov^T
+    downdates = np.matmul(kalman, mesSqrtCov.transpose())
+    try:
+        sqrtCov = predSqrtCov.copy()
+        for i in range(m):
+            sqrtCov = cholUpdate(sqrtCov, downdates[:, i], -1)
+    except np.linalg.LinAlgError:
+        # rounding left a downdate indefinite, so rebuild the factor with QR from eq 17 written as a sum of outer products:
+        # cov = sum of weighted (predDeviations - kalman * mesDeviations) outer products + q + kalman * r * kalman^T
+        sqrtCov = generateSqrtCov(np.subtract(predDeviations, np.matmul(np.subtract(h, mesMeans), kalman.transpose())),
+            w0_c, w1, np.vstack((sqrtQ, np.matmul(sqrtR, kalman.transpose()))))
+
+    return [means, sqrtCov]
+
+
+class UKFilter():
+    '''
+    Persistent unscented kalman filter. Configured once with its dynamics and measurement models, noise matrices
+    and scaling parameters. Every intermediate of step() is written into a fixed workspace owned by the filter,
+    so after the first call (warm-up) a step allocates no new arrays as long as its inputs are float numpy arrays
+    and the B field is passed in directly
+
+    The means and cov returned by step() are views of that workspace and are overwritten by the next step,
+    so copy them if a history is needed
+
+    Usage:
+        ukf_filter = UKFilter(createEOMS(), hfunc_batch, state, cov, q, r)
+        state, cov = ukf_filter.step(gps_data, reaction_speeds, old_reaction_speeds, data)
+    '''
+    def __init__(self, eomsClass, measurementModel, means, cov, q, r, alpha=0.001, beta=2, kappa=0, dt=0.1, normalizeQuaternion=True):
+        '''
+        @params
+            eomsClass: EOMs class to pass our sigma points through (must implement eoms_batch with out and work)
+            measurementModel: batched transformation into measurement space,
+                func(sigmaPoints, Bfield, out, work) (such as hfunc_batch), where work is scratch of shape (n x 2*n+1)
+            means: starting state estimate (1 x n)
+            cov: starting covariance matrix of state (n x n)
+            q: process noise covariance matrix (n x n)
+            r: measurement noise covariance matrix (m x m)
+            alpha, kappa: scale sigma points around the mean (see UKF)
+            beta: minimizes higher order errors in covariance estimation
+            dt: time step of EOMs propagation
+            normalizeQuaternion: if True, normalize first 4 elements of state after every step
+        '''
+        self.eomsClass = eomsClass
+        self.measurementModel = measurementModel
+        self.normalizeQuaternion = normalizeQuaternion
+        self.dt = dt
+
+        self.means = np.array(means, dtype=float)
+        self.cov = np.array(cov, dtype=float)
+        self.q = np.array(q, dtype=float)
+        self.r = np.array(r, dtype=float)
+
+        # dimensionality of state space and measurement space
+        self.n = len(self.means)
+        self.m = len(self.r)
+        n = self.n
+        m = self.m
+
+        # eq 1: scaling factor lambda
+        self.scaling = alpha * alpha * (n + kappa) - n
+
+        # eq 2-4: weights calculation
+        self.w0_m = self.scaling / (n + self.scaling) # weight for first value for means
+        self.w0_c = self.scaling / (n + self.scaling) + (1 - alpha * alpha + beta) # weight for first value for covariance
+        self.w1 = 1 / (2 * (n + self.scaling)) # weight for all other values
+
+        # weight vector for all sigma points, so weighted means become single matrix products
+        self.meanWeights = np.full(2*n+1, self.w1)
+        self.meanWeights[0] = self.w0_m
+        covWeights = np.full(2*n+1, self.w1)
+        covWeights[0] = self.w0_c
+
+        # diagonal matrix of covariance weights, so cov = (covWeightMatrix * deviations)^T * deviations
+        self.covWeightMatrix = np.diag(covWeights)
+
+        # expansion matrix: sigma points = sigmaExpand * [means; sqrt], placing means +- each row of sqrt (eq 5-7)
+        self.sigmaExpand = np.zeros((2*n+1, n+1))
+        self.sigmaExpand[:, 0] = 1
+        self.sigmaExpand[1:(n+1), 1:] = np.identity(n)
+        self.sigmaExpand[(n+1):, 1:] = -np.identity(n)
+
+        # workspace that is filled in place every step
+        self.sigmaBasis = np.zeros((n+1, n))
+        self.sigmaPoints = np.zeros((2*n+1, n))
+        self.f = np.zeros((2*n+1, n))
+        self.fWork = np.zeros((4, 2*n+1, 3))
+        self.predMeans = np.zeros(n)
+        self.predDeviations = np.zeros((2*n+1, n))
+        self.weightedDeviations = np.zeros((2*n+1, n))
+        self.predCov = np.zeros((n, n))
+        self.h = np.zeros((2*n+1, m))
+        self.hWork = np.zeros((n, 2*n+1))
+        self.mesMeans = np.zeros(m)
+        self.mesDeviations = np.zeros((2*n+1, m))
+        self.weightedMesDeviations = np.zeros((2*n+1, m))
+        self.mesCov = np.zeros((m, m))
+        self.mesFactor = np.zeros((m, m))
+        self.crossCov = np.zeros((n, m))
+        self.kalman = np.zeros((n, m))
+        self.kalmanMesCov = np.zeros((n, m))
+        self.innovation = np.zeros(m)
+        self.correction = np.zeros(n)
+
+        # angular acceleration of wheels, shaped on first step to match reaction wheel speeds
+        self.alpha_rw = None
+
+    def choleskyInPlace(self, matrix, factor):
+        '''
+        choleskyInPlace
+            writes upper triangular cholesky factor of matrix into factor without allocating, falling back
+            to choleskyFactor (which repairs non positive definite matrices) if the factorization fails
+
+        @params
+            matrix: symmetric positive definite matrix to factor (k x k), not modified
+            factor: buffer for upper triangular factor (k x k)
+
+        @returns
+            factor: upper triangular factor, matrix = factor^T * factor
+        '''
+        np.copyto(factor, matrix)
+        # lapack works in fortran order, so the lower factor of factor^T is our upper factor in place
+        factor_t, info = scipy.linalg.lapack.dpotrf(factor.T, lower=1, clean=1, overwrite_a=1)
+        if info != 0:
+            np.copyto(factor, choleskyFactor(matrix))
+        return factor
+
+    def step(self, gps_data, reaction_speeds, old_reaction_speeds, data):
+        '''
+        step
+            estimates state at next time step based on sensor data, noise, and equations of motion (same as UKF)
+
+        @params
+            gps_data: control input vector for hfunc (gps data: longitude, latitude, height, time), or b field vector
+            reaction_speeds: control input for EOMs (1 x 3 for 1d test)
+            old_reaction_speeds: speeds for past step, used to find angular acceleration (1 x 3 for 1d test)
+            data: magnetometer (magnetic field) and gyroscope (angular velocity) data reading from sensor (1 x m)
+
+        @returns
+            means: calculated state estimate at current time (1 x n), view of workspace
+            cov: covariance matrix (n x n), view of workspace
+        '''
+        n = self.n
+
+        # eq 5-7: sigma point generation, means +- rows of cholesky factor of (n + scaling) * cov
+        np.multiply(self.cov, n + self.scaling, out=self.predCov)
+        self.sigmaBasis[0] = self.means
+        self.choleskyInPlace(self.predCov, self.sigmaBasis[1:])
+        np.matmul(self.sigmaExpand, self.sigmaBasis, out=self.sigmaPoints)
+
+        # calculate angular acceleration using old and current reaction wheel speeds
+        if self.alpha_rw is None:
+            self.alpha_rw = np.zeros(np.shape(reaction_speeds))
+        np.subtract(reaction_speeds, old_reaction_speeds, out=self.alpha_rw)
+        self.alpha_rw /= self.dt
+
+        # eq 8-9: pass sigma points through EOMs (f) and generate mean in state space
+        self.eomsClass.eoms_batch(self.sigmaPoints, reaction_speeds, 0, self.alpha_rw, self.dt, out=self.f, work=self.fWork)
+        np.matmul(self.meanWeights, self.f, out=self.predMeans)
+
+        # eq 10: predicted covariance + process noise q, as a product of weighted deviations
+        for i in range(2*n+1):
+            np.subtract(self.f[i], self.predMeans, out=self.predDeviations[i])
+        np.matmul(self.covWeightMatrix, self.predDeviations, out=self.weightedDeviations)
+        np.matmul(self.weightedDeviations.T, self.predDeviations, out=self.predCov)
+        self.predCov += self.q
+
+        if len(gps_data) == 4:
+            # finds true B field based on gps data
+            Bfield = bfield_calc(gps_data)
+        else:
+            # for ideal tests only, use gps_data as b field vector and skip calculating it from the gps data
+            Bfield = gps_data
+
+        # eq 11-12: non linear transformation of predicted sigma points f into measurement space (h), and mean generation
+        self.measurementModel(self.f, Bfield, out=self.h, work=self.hWork)
+        np.matmul(self.meanWeights, self.h, out=self.mesMeans)
+
+        # eq 13: measurement covariance + measurement noise r
+        for i in range(2*n+1):
+            np.subtract(self.h[i], self.mesMeans, out=self.mesDeviations[i])
+        np.matmul(self.covWeightMatrix, self.mesDeviations, out=self.weightedMesDeviations)
+        np.matmul(self.weightedMesDeviations.T, self.mesDeviations, out=self.mesCov)
+        self.mesCov += self.r
+
+        # eq 14: cross covariance. compare our different sets of sigma points and our predicted/measurement means
+        np.matmul(self.weightedDeviations.T, self.mesDeviations, out=self.crossCov)
+
+        # eq 15: kalman gain = crossCov * mesCov^-1, found by solving mesCov * kalman^T = crossCov^T in place with its cholesky factor
+        # (the solution is written straight into kalman, since kalman^T is the fortran ordered view lapack works on)
+        self.choleskyInPlace(self.mesCov, self.mesFactor)
+        np.copyto(self.kalman, self.crossCov)
+        scipy.linalg.lapack.dpotrs(self.mesFactor.T, self.kalman.T, lower=1, overwrite_b=1)
+
+        # eq 16: updated final mean = predicted + kalman(measurement data - predicted means in measurement space)
+        np.subtract(data, self.mesMeans, out=self.innovation)
+        np.matmul(self.kalman, self.innovation, out=self.correction)
+        np.add(self.predMeans, self.correction, out=self.means)
+
+        # normalize the quaternion to reduce small calculation errors over time
+        if self.normalizeQuaternion:
+            self.means[0:4] /= np.linalg.norm(self.means[0:4])
+
+        # eq 17: updated covariance = predicted covariance - kalman * measurement cov * transposed kalman
+        np.matmul(self.kalman, self.mesCov, out=self.kalmanMesCov)
+        np.matmul(self.kalmanMesCov, self.kalman.T, out=self.cov)
+        np.subtract(self.predCov, self.cov, out=self.cov)
+
+        return [self.means, self.cov]
+
+
+class BatchUKFilter():
+    '''
+    Advances N independent unscented kalman filters in lockstep, for monte carlo runs and tuning of q and r.
+    State of every filter is stacked into (N x n) means and (N x n x n) covariances, and each stage of the UKF is done
+    for all filters at once with batched linear algebra, instead of N separate calls to UKF
+
+    All filters share the same EOMs, B field and reaction wheel inputs, while noise matrices may be shared (n x n, m x m)
+    or given per filter (N x n x n, N x m x m) so a sweep over q and r can run as one batch
+
+    Usage:
+        filters = BatchUKFilter(createEOMS(), hfunc_batch, states, covs, q, r)
+        states, covs = filters.step(Bfield, reaction_speeds, old_reaction_speeds, data)
+    '''
+    def __init__(self, eomsClass, measurementModel, means, cov, q, r, alpha=0.001, beta=2, kappa=0, dt=0.1, normalizeQuaternion=True):
+        '''
+        @params
+            eomsClass: EOMs class to pass our sigma points through (must implement eoms_batch)
+            measurementModel: batched transformation into measurement space, func(sigmaPoints, Bfield) (such as hfunc_batch)
+            means: starting state estimate of every filter (N x n)
+            cov: starting covariance matrix of every filter (N x n x n), or one shared by all of them (n x n)
+            q: process noise covariance matrix (n x n or N x n x n)
+            r: measurement noise covariance matrix (m x m or N x m x m)
+            alpha, kappa: scale sigma points around the mean (see UKF)
+            beta: minimizes higher order errors in covariance estimation
+            dt: time step of EOMs propagation
+            normalizeQuaternion: if True, normalize first 4 elements of every state after every step
+        '''
+        self.eomsClass = eomsClass
+        self.measurementModel = measurementModel
+        self.normalizeQuaternion = normalizeQuaternion
+        self.dt = dt
+
+        self.means = np.array(means, dtype=float)
+        self.q = np.array(q, dtype=float)
+        self.r = np.array(r, dtype=float)
+
+        # number of filters, and dimensionality of state space and measurement space
+        self.N, self.n = self.means.shape
+        self.m = self.r.shape[-1]
+        n = self.n
+
+        self.cov = np.array(np.broadcast_to(cov, (self.N, n, n)), dtype=float)
+
+        # eq 1: scaling factor lambda
+        self.scaling = alpha * alpha * (n + kappa) - n
+
+        # eq 2-4: weights calculation, as vectors over all sigma points
+        self.meanWeights = np.full(2*n+1, 1 / (2 * (n + self.scaling)))
+        self.meanWeights[0] = self.scaling / (n + self.scaling)
+        self.covWeights = np.full(2*n+1, 1 / (2 * (n + self.scaling)))
+        self.covWeights[0] = self.scaling / (n + self.scaling) + (1 - alpha * alpha + beta)
+
+    def sigma(self):
+        '''
+        sigma
+            creates sigma point matrices of every filter (eq 5-7), using a batched cholesky factorization.
+            if any covariance is no longer positive definite, every filter is factored with choleskyFactor instead,
+            which repairs the ones that need it
+
+        @returns
+            sigmaPoints: sigma point matrix of every filter (N x 2*n+1 x n)
+        '''
+        N = self.N
+        n = self.n
+
+        scaledCov = self.cov * (n + self.scaling)
+        try:
+            # numpy gives lower factors, whose transposes have our sigma point offsets as rows
+            factors = np.linalg.cholesky(scaledCov).transpose(0, 2, 1)
+        except np.linalg.LinAlgError:
+            factors = np.array([choleskyFactor(scaledCov[i]) for i in range(N)])
+
+        sigmaPoints = np.empty((N, 2*n+1, n))
+        sigmaPoints[:, 0] = self.means
+        sigmaPoints[:, 1:(n+1)] = self.means[:, np.newaxis, :] + factors
+        sigmaPoints[:, (n+1):] = self.means[:, np.newaxis, :] - factors
+
+        return sigmaPoints
+
+    def step(self, gps_data, reaction_speeds, old_reaction_speeds, data):
+        '''
+        step
+            estimates state of every filter at next time step based on its sensor data, noise, and equations of motion
+
+        @params
+            gps_data: control input vector for hfunc (gps data: longitude, latitude, height, time), or b field vector (1 x 3)
+            reaction_speeds: control input for EOMs (1 x 3 for 1d test)
+            old_reaction_speeds: speeds for past step, used to find angular acceleration (1 x 3 for 1d test)
+            data: magnetometer (magnetic field) and gyroscope (angular velocity) data reading of every filter (N x m)
+
+        @returns
+            means: calculated state estimate of every filter at current time (N x n)
+            cov: covariance matrix of every filter (N x n x n)
+        '''
+        N = self.N
+        n = self.n
+        m = self.m
+
+        # eq 5-7: sigma point generation
+        sigmaPoints = self.sigma()
+
+        # eq 8-9: pass sigma points of every filter through EOMs (f) as one block of rows, and generate means in state space
+        alpha_rw = (np.asarray(reaction_speeds) - np.asarray(old_reaction_speeds)) / self.dt
+        f = self.eomsClass.eoms_batch(sigmaPoints.reshape(N * (2*n+1), n), reaction_speeds, 0, alpha_rw, self.dt)
+        f = f.reshape(N, 2*n+1, n)
+        predMeans = np.matmul(self.meanWeights, f)
+
+        # eq 10: predicted covariance + process noise q, as a product of weighted deviations for every filter
+        predDeviations = f - predMeans[:, np.newaxis, :]
+        predCov = np.matmul(predDeviations.transpose(0, 2, 1) * self.covWeights, predDeviations) + self.q
+
+        if len(gps_data) == 4:
+            # finds true B field based on gps data
+            Bfield = bfield_calc(gps_data)
+        else:
+            # for ideal tests only, use gps_data as b field vector and skip calculating it from the gps data
+            Bfield = gps_data
+
+        # eq 11-12: non linear transformation of predicted sigma points f into measurement space (h), and mean generation
+        h = self.measurementModel(f.reshape(N * (2*n+1), n), Bfield).reshape(N, 2*n+1, m)
+        mesMeans = np.matmul(self.meanWeights, h)
+
+        # eq 13: measurement covariance + measurement noise r
+        mesDeviations = h - mesMeans[:, np.newaxis, :]
+        weightedPredDeviations = predDeviations.transpose(0, 2, 1) * self.covWeights
+        mesCov = np.matmul(mesDeviations.transpose(0, 2, 1) * self.covWeights, mesDeviations) + self.r
+
+        # eq 14: cross covariance of every filter
+        crossCov = np.matmul(weightedPredDeviations, mesDeviations)
+
+        # eq 15: kalman gain = crossCov * mesCov^-1, from a batched solve of mesCov * kalman^T = crossCov^T
+        kalman = np.linalg.solve(mesCov, crossCov.transpose(0, 2, 1)).transpose(0, 2, 1)
+
+        # eq 16: updated final mean = predicted + kalman(measurement data - predicted means in measurement space)
+        innovation = np.asarray(data, dtype=float) - mesMeans
+        self.means = predMeans + np.matmul(kalman, innovation[:, :, np.newaxis])[:, :, 0]
+
+        # normalize the quaternions to reduce small calculation errors over time
+        if self.normalizeQuaternion:
+            self.means[:, 0:4] /= np.linalg.norm(self.means[:, 0:4], axis=1, keepdims=True)
+
+        # eq 17: updated covariance = predicted covariance - kalman * measurement cov * transposed kalman
+        self.cov = predCov - np.matmul(np.matmul(kalman, mesCov), kalman.transpose(0, 2, 1))
+
+        return [self.means, self.cov]
@@ -36,6 +36,43 @@ from hfunc_1D import *
 from typing import Optional
 
 
+def choleskyFactor(cov):
+    '''
+    choleskyFactor
+        finds upper triangular matrix square root U of cov (cov = U^T * U) using a cholesky factorization
+        if cov has drifted away from positive definite, it is repaired by symmetrizing, clipping its eigenvalues
+        to a small positive floor, and adding increasing jitter to the diagonal until the factorization succeeds
+
+    @params
+        cov: symmetric covariance matrix to factor (n x n)
+
+    @returns
+        factor: upper triangular matrix whose rows sum in outer product to cov (n x n)
+    '''
+    try:
+        # numpy returns lower triangular L with cov = L * L^T, so its transpose is our upper factor
+        return np.linalg.cholesky(cov).T
+    except np.linalg.LinAlgError:
+        pass
+
+    # force symmetry, then clip negative or zero eigenvalues to a floor relative to the largest one
+    sym = (cov + cov.T) / 2
+    vals, vecs = np.linalg.eigh(sym)
+    floor = np.finfo(float).eps * max(np.abs(vals).max(), np.finfo(float).tiny)
+    vals = np.maximum(vals, floor)
+    repaired = np.matmul(vecs * vals, vecs.T)
+
+    # add jitter to the diagonal, growing by an order of magnitude until the factorization succeeds
+    jitter = floor
+    for i in range(10):
+        try:
+            return np.linalg.cholesky(repaired + jitter * np.identity(len(cov))).T
+        except np.linalg.LinAlgError:
+            jitter *= 10
+
+    raise np.linalg.LinAlgError("covariance matrix could not be repaired to positive definite")
+
+
 def sigma(means, cov, n, scaling):
     '''
     sigma
@@ -53,14 +90,13 @@ def sigma(means, cov, n, scaling):
     '''
     # intialize 2N + 1 sigma points to zeroes
     sigmaMatrix = np.zeros((2*n+1,n))
-    temp = np.zeros((n, n))
 
     # 1) sigma point generation
     # first column of sigma matrix is means
     sigmaMatrix[0] = means
 
-    # take the square root of the inside
-    temp = scipy.linalg.sqrtm(np.multiply(cov, (n + scaling)))
+    # take the square root of the inside using a cholesky factor (repaired if no longer positive definite)
+    temp = choleskyFactor(np.multiply(cov, (n + scaling)))
 
     # traverse n dimensions, calculating all other sigma points
     # means + sqrt for 1 to n
@@ -120,6 +156,69 @@ class DEMO_1D_EOMS():
 
         return new_state
 
+    def eoms_batch(self, states: np.ndarray, w_rw, tau_sat, alpha_rw: float, dt: float, out=None, work=None):
+        ''' Batched version of eoms that propagates every row of a state matrix (such as the sigma point matrix) at once.
+        Takes the same arguments as TEST1EOMS.eoms_batch so either can be used by a UKFilter; w_rw, tau_sat and work are unused here
+
+        Args:
+            states (np.ndarray, (N x 2)): rows of [psi, psi_dot] to propagate
+            alpha_rw (float): angular acceleration of the reaction wheel
+            dt (float)
+            out (np.ndarray, (N x 2)): optional buffer to write propagated rows into
+        Out:
+            new_states (np.ndarray, (N x 2)): propagated rows of [psi, psi_dot]
+        '''
+
+        # Calculate psi_ddot, i.e. angular acceleration, which is the same for every row
+        psi_ddot = -(self.I_w_spin/self.I_body[2, 2]) * alpha_rw
+
+        # Propagate
+        new_states = np.empty((states.shape[0], 2)) if out is None else out
+        np.multiply(states[:, 1], dt, out=new_states[:, 0])
+        new_states[:, 0] += states[:, 0]
+        np.add(states[:, 1], psi_ddot * dt, out=new_states[:, 1])
+
+        return new_states
+
+def createEOMS():
+    '''
+    createEOMS
+        builds the 1D demo EOMs using the measured inertia constants of our cubeSat, rotated into our body frame
+
+    @returns
+        EOMS: DEMO_1D_EOMS instance
+    '''
+    # intertia constants from juwan
+    I_body = np.array([[2337899.19, -14882.35, 38212.04],
+              [-14882.35, 5112345.28,19754.53],
+              [38212.04, 19754.53, 5387496.72]])
+    I_body = I_body * 1e-7
+
+    # Reorder moment of inertia matrix. This is as the moment of inertia
+    # was calculated in CAD where y is pointing up vertically, while our body frame
+    # uses z as pointing up vertically. Transform from CAD to body frame is rotation
+    # about X by 90 degrees
+    Ixx = I_body[0,0]
+    Ixy = I_body[0,1]
+    Ixz = I_body[0,2]
+    Iyx = I_body[1,0]
+    Iyy = I_body[1,1]
+    Iyz = I_body[1,2]
+    Izx = I_body[2,0]
+    Izy = I_body[2,1]
+    Izz = I_body[2,2]
+
+    # Define rotated I (given by [R][I][R]^T)
+    I_body = np.array([[Ixx, -Ixz, Ixy],
+                       [-Izx, Izz, -Izy],
+                       [Iyx, -Iyz, Iyy]])
+
+    # Define I_spin and I_trans of RW
+    I_spin = 0.319 * 1.82899783e-5 # kg (m^2)
+    I_trans = 0
+
+    return DEMO_1D_EOMS(I_body, I_spin, I_trans)
+
 class TEST1EOMS():
     '''
     Equations of motion class for 1D test specifically--does not implement 3rd reaction wheel
@@ -307,10 +406,11 @@ def generateMesMeans(func, controlVector, sigmaPoints, w0, w1, n, dimensionality
     return means, transformedSigma
 
 
-def generateCov(means, transformedSigma, w0, w1, n, noise):
+def generateCov(means, transformedSigma, w0, w1, n, noise, out=None):
     '''
     generateCov
         generates covariance matrix from eq 10 and 13 based on means and sigma points
+        all sigma points are handled at once by weighting the matrix of deviations from the mean
         
     @params
         means: means in state or measurement space (1 x n or 1 x m)
@@ -318,44 +418,32 @@ def generateCov(means, transformedSigma, w0, w1, n, noise):
         w0, w1: weight for first and all other sigma points, respectively
         n: dimensionality of model 
         noise: noise value array to apply to our cov matrix (r or q)
+        out: optional buffer to write covariance into (n x n or m x m)
         
     @returns
         cov: covariance matrix in state or measurement space (n x n or m x m)
     '''
-    # find dimension of cov by looking at size of sigma point array
-    # prediction points will have n columns, measurement points will have m columns
-    covDimension = transformedSigma.shape[1]
-    
-    # initialize cov with proper dimensionality
-    cov = np.zeros((covDimension, covDimension))
-
-    # for all transformed sigma points, apply covariance formula
-    for i in range(1, n * 2 + 1):
-        # subtract mean from sigma point and multiply by itself transposed
-        arr = np.subtract(transformedSigma[i], means)[np.newaxis]
-        arr = np.matmul(arr.transpose(), arr)
-        cov = np.add(cov, arr)
-    
-    # separate out first value and update with correct weight
-    arr = np.subtract(transformedSigma[0], means)[np.newaxis]
-    d = np.matmul(arr.transpose(), arr) * w0
+    # subtract mean from every sigma point (n*2+1 x n or n*2+1 x m)
+    deviations = np.subtract(transformedSigma, means)
 
-    # use other weight for remaining values
-    cov *= w1
+    # weight vector for sigma points: first weight for first point, other weight for all remaining points
+    weights = np.full(2 * n + 1, w1)
+    weights[0] = w0
 
-    # add back first element
-    cov = np.add(cov, d)
+    # sum of weighted outer products of every deviation with itself, as a single matrix product
+    cov = np.matmul(deviations.T * weights, deviations, out=out)
 
     # add noise to covariance matrix
-    cov = np.add(cov, noise)
+    cov += noise
 
     return cov
 
 
-def generateCrossCov(predMeans, mesMeans, f, h, w0, w1, n):
+def generateCrossCov(predMeans, mesMeans, f, h, w0, w1, n, out=None):
     '''
     generateCrossCov
         use equation 14 to generate cross covariance between our means and sigma points in our state and measurement space
+        all sigma points are handled at once by weighting the matrices of deviations from the means
 
     @params
         predMeans: predicted means based on EOMs (1 x n)
@@ -365,31 +453,21 @@ def generateCrossCov(predMeans, mesMeans, f, h, w0, w1, n):
         w0: weight for first value
         w1: weight for other values
         n: dimensionality of model
+        out: optional buffer to write cross covariance into (n x m)
     
     @returns
         crossCov: represents uncertainty between our state and measurement space estimates (n x m)
     '''
-    m = len(mesMeans)
-    crossCov = np.zeros((n,m))
+    # deviations of every sigma point from the means in state and measurement space
+    predDeviations = np.subtract(f, predMeans)
+    mesDeviations = np.subtract(h, mesMeans)
 
-    for i in range(1, n * 2 + 1):
-        arr1 = np.subtract(f[i], predMeans)[np.newaxis]
-        arr2 = np.subtract(h[i], mesMeans)[np.newaxis]
-        arr1 = np.matmul(arr1.transpose(), arr2)  # ordering?
-        crossCov = np.add(crossCov, arr1)
-
-    arr1 = np.subtract(f[0], predMeans)[np.newaxis]
-    arr2 = np.subtract(h[0], mesMeans)[np.newaxis]
-
-    # seperate out first element
-    d = np.matmul(arr1.transpose(), arr2)
+    # weight vector for sigma points: first weight for first point, other weight for all remaining points
+    weights = np.full(2 * n + 1, w1)
+    weights[0] = w0
 
-    # multiply by weights for first and other values
-    crossCov = np.multiply(crossCov, w1)
-    d = np.multiply(d, w0)
-
-    # add first value back into cross covariance
-    crossCov = np.add(crossCov, d)
+    # sum of weighted outer products between state and measurement deviations, as a single matrix product
+    crossCov = np.matmul(predDeviations.T * weights, mesDeviations, out=out)
 
     return crossCov
 
@@ -444,37 +522,8 @@ def UKF(means, cov, q, r, gps_data, reaction_speed, old_reaction_speed, data):
 
 
     # prediction step
-    # intertia constants from juwan
-    I_body = np.array([[2337899.19, -14882.35, 38212.04],
-              [-14882.35, 5112345.28,19754.53],
-              [38212.04, 19754.53, 5387496.72]])
-    I_body = I_body * 1e-7
-
-    # Reorder moment of inertia matrix. This is as the moment of inertia
-    # was calculated in CAD where y is pointing up vertically, while our body frame
-    # uses z as pointing up vertically. Transform from CAD to body frame is rotation
-    # about X by 90 degrees
-    Ixx = I_body[0,0]
-    Ixy = I_body[0,1]
-    Ixz = I_body[0,2]
-    Iyx = I_body[1,0]
-    Iyy = I_body[1,1]
-    Iyz = I_body[1,2]
-    Izx = I_body[2,0]
-    Izy = I_body[2,1]
-    Izz = I_body[2,2]
-
-    # Define rotated I (given by [R][I][R]^T)
-    I_body = np.array([[Ixx, -Ixz, Ixy],
-                       [-Izx, Izz, -Izy],
-                       [Iyx, -Iyz, Iyy]])
-
-    # Define I_spin and I_trans of RW
-    I_spin = 0.319 * 1.82899783e-5 # kg (m^2)
-    I_trans = 0
-
     # intialize 1D EOMs using intertia measurements of cubeSat
-    EOMS = DEMO_1D_EOMS(I_body, I_spin, I_trans)
+    EOMS = createEOMS()
     
     # eq 8-9: pass sigma points through EOMs (f) and generate mean in state space
     predMeans, f = generatePredMeans(EOMS, sigmaPoints, w0_m, w1, reaction_speed, old_reaction_speed, n)
@@ -6,6 +6,7 @@ Last modified: 11/5/2023
 Transformation function hfunc for IrishSat Unscented Kalman Filter. Requires wmm.py and associated files.
 '''
 
+import functools
 import numpy as np
 import matplotlib.pyplot as plt
 from PySOL.wmm import WMM
@@ -40,36 +41,202 @@ def hfunc(state, Bfield):
     return np.concatenate((np.matmul(rotationMatrix, Bfield).ravel(), np.array(state[4:])))
 
 
+def hfunc_batch(states, Bfield, out=None, work=None):
+    '''
+    hfunc_batch
+        batched hfunc: transforms every row of a state matrix (such as the sigma point matrix) into measurement space at once.
+        Applies the rotation matrix of each row's quaternion to the B field, written as R*B = 2*q0^2*B + 2*(v.B)*v + 2*q0*(v x B) - B
+        with v = (q1, q2, q3), which matches quaternion_rotation_matrix term by term (including for non-unit quaternions).
+        Allocates no new arrays if out and work are given
+
+    @params
+        states: rows of state estimates-quaternion, angular velocity (N x n)
+        Bfield: B field of state (1 x 3)
+        out: optional buffer to write measurements into (N x n-1)
+        work: optional scratch array of at least 4 rows (4 x N)
+
+    @returns
+        measurements: rows of states in measurement space (N x n-1)
+    '''
+    Bfield = np.ravel(Bfield)
+    rows = states.shape[0]
+    if out is None:
+        out = np.empty((rows, states.shape[1] - 1))
+    if work is None:
+        work = np.empty((4, rows))
+
+    q0 = states[:, 0]
+    v = (states[:, 1], states[:, 2], states[:, 3])
+    dot = work[0]
+    q0_sq = work[1]
+    temp = work[2]
+    temp2 = work[3]
+
+    # v.B and q0^2 for every row
+    np.multiply(v[0], Bfield[0], out=dot)
+    np.multiply(v[1], Bfield[1], out=temp)
+    dot += temp
+    np.multiply(v[2], Bfield[2], out=temp)
+    dot += temp
+    np.multiply(q0, q0, out=q0_sq)
+
+    for i in range(3):
+        j = (i + 1) % 3
+        k = (i + 2) % 3
+        column = out[:, i]
+
+        # 2*q0^2*B - B
+        np.multiply(q0_sq, 2 * Bfield[i], out=column)
+        column -= Bfield[i]
+
+        # 2*(v.B)*v
+        np.multiply(dot, v[i], out=temp)
+        temp *= 2
+        column += temp
+
+        # 2*q0*(v x B)
+        np.multiply(v[j], Bfield[k], out=temp)
+        np.multiply(v[k], Bfield[j], out=temp2)
+        temp -= temp2
+        temp *= q0
+        temp *= 2
+        column += temp
+
+    # other elements of state have 1 to 1 conversion
+    out[:, 3:] = states[:, 4:]
+
+    return out
+
+
+# process-wide WMM model, built on first use so that every B field calculation shares one copy of the coefficients
+_wmm_model = None
+
+# optional precomputed field grid (PySOL.wmm.WMMGrid) used instead of the model, see setBfieldGrid
+_bfield_grid = None
+
+# gps inputs are rounded to these steps (degrees, degrees, height units, decimal years) to form B field cache keys
+BFIELD_CACHE_RESOLUTION = (1e-6, 1e-6, 1e-3, 1e-8)
+
+# number of quantized gps points whose B field is remembered
+BFIELD_CACHE_SIZE = 4096
+
+
+def getWMM():
+    '''
+    getWMM
+        returns the shared WMM model, reading the coefficient file only the first time it is called
+
+    @returns
+        wmm_model: WMM model of degree 12
+    '''
+    global _wmm_model
+    if _wmm_model is None:
+        _wmm_model = WMM(12, 'WMMcoef.csv')
+    return _wmm_model
+
+
+def setBfieldGrid(grid):
+    '''
+    setBfieldGrid
+        makes B field calculations interpolate a precomputed field grid instead of evaluating the full WMM model,
+        for loops that cannot afford the spherical harmonic sums every step. The grid is built for a single epoch,
+        so the time of each gps point is ignored while it is set
+
+    @params
+        grid: WMMGrid to use (from PySOL.wmm), or None to go back to the full model
+    '''
+    global _bfield_grid
+    _bfield_grid = grid
+    clearBfieldCache()
+
+
+def wmmBfield(lat, long, height, time):
+    '''
+    wmmBfield
+        evaluates the shared WMM model (or the field grid, if one is set) at the given gps points, without any caching
+
+    @params
+        lat, long: geodetic latitude and longitude of points in degrees
+        height: height of points above the ellipsoid
+        time: time of points in decimal years
+
+    @returns
+        converted: magnetic field at every point in microteslas (3 x number of points)
+    '''
+    # copy inputs, as WMM converts degrees to radians in place
+    lat, long, height, time = (np.array(x, dtype=float, ndmin=1) for x in (lat, long, height, time))
+
+    if _bfield_grid is not None:
+        return _bfield_grid.calc_field(lat, long, height).T / 1000
+
+    wmm_model = getWMM()
+    wmm_model.calc_gcc_components(lat, long, height, time, degrees=True)
+
+    # Convert nanotesla to microtesla
+    return wmm_model.get_Bfield() / 1000
+
+
+@functools.lru_cache(maxsize=BFIELD_CACHE_SIZE)
+def _cachedBfield(key):
+    '''
+    _cachedBfield
+        B field at the center of a quantized gps cell, so every input rounding to key gets the same answer
+
+    @params
+        key: gps point as integer multiples of BFIELD_CACHE_RESOLUTION (lat, long, height, time)
+
+    @returns
+        converted: read only magnetic field in microteslas (3 x 1)
+    '''
+    converted = wmmBfield(*(k * resolution for k, resolution in zip(key, BFIELD_CACHE_RESOLUTION)))
+    converted.flags.writeable = False
+    return converted
+
+
+def bfieldCacheInfo():
+    '''
+    bfieldCacheInfo
+        statistics of the B field cache
+
+    @returns
+        info: named tuple of hits, misses, maxsize, and currsize
+    '''
+    return _cachedBfield.cache_info()
+
+
+def clearBfieldCache():
+    '''
+    clearBfieldCache
+        empties the B field cache and resets its hit/miss counters
+    '''
+    _cachedBfield.cache_clear()
 
 
 def bfield_calc(controls):
     '''
     bfield_calc
-        calculates the current true magnetic field based on gps data input
+        calculates the current true magnetic field based on gps data input.
+        Uses the shared WMM model, and remembers the field of recently seen gps points (rounded to BFIELD_CACHE_RESOLUTION)
     
     @params
         controls: gps and time data for current time step (latitude, longitude, height, time arrays) (1 x 4)
 
     @returns
-        converted: true, earth centered (eci frame) magnetic field in ???? units (1 x 3)
+        converted: true, earth centered (eci frame) magnetic field in microteslas (3 x 1)
     '''
     # get lat, long, and height from control input vector
-    lat = controls[0] 
-    long = controls[1]
-    height = controls[2] 
-
     # time data formatted as 2023.percentage of the year in month type stuff
-    time = controls[3] 
+    gps = [np.asarray(x, dtype=float) for x in controls[:4]]
 
-    # calculate wmm: b frame with respect to eci frame (earth-centered)
-    wmm_model = WMM(12, 'WMMcoef.csv')
-    wmm_model.calc_gcc_components(lat, long, height, time, degrees=True)
-    Bfield1 = wmm_model.get_Bfield()
-    
-    # Convert nanotesla to microtesla
-    converted = Bfield1 / 1000
+    # several points at once are evaluated directly
+    if any(x.size != 1 for x in gps):
+        return wmmBfield(*gps)
 
-    return converted
+    # calculate wmm: b frame with respect to eci frame (earth-centered), or look it up if this point was seen before
+    key = tuple(int(np.rint(x.item() / resolution)) for x, resolution in zip(gps, BFIELD_CACHE_RESOLUTION))
+
+    # copy so that callers can modify their field without touching the cache
+    return _cachedBfield(key).copy()
 
 
 def quaternion_rotation_matrix(Q):
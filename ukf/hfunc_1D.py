@@ -26,6 +26,36 @@ def hfunc(state, B_true):
     
     return np.append(Bmeas, state[1])
 
+def hfunc_batch(states, B_true, out=None, work=None):
+    '''
+    hfunc_batch
+        batched hfunc: transforms every row of a state matrix (such as the sigma point matrix) into measurement space at once
+        allocates no new arrays if out (N x 3) and work (2 x N) are given
+    '''
+    rows = states.shape[0]
+    if out is None:
+        out = np.empty((rows, 3))
+    if work is None:
+        work = np.empty((2, rows))
+
+    # find angle in xy plane for every row
+    psi = states[:, 0] # rad
+    cos_psi = np.cos(psi, out=work[0])
+    sin_psi = np.sin(psi, out=work[1])
+
+    # calculate measured B-field for every row: [cos*Bx - sin*By, sin*Bx + cos*By]
+    np.multiply(cos_psi, B_true[0], out=out[:, 0])
+    np.multiply(sin_psi, B_true[0], out=out[:, 1])
+    cos_psi *= B_true[1]
+    sin_psi *= B_true[1]
+    out[:, 0] -= sin_psi
+    out[:, 1] += cos_psi
+
+    # angular velocity maps 1 to 1
+    out[:, 2] = states[:, 1]
+
+    return out
+
 def angle2quat(psi):
     ''' Takes in angle psi (Euler angle about Z axis) and returns quaternion
     '''
@@ -0,0 +1,111 @@
+'''
+test_allocation.py
+
+Checks that a warmed up UKFilter.step allocates no new arrays, using tracemalloc.
+Run directly or with pytest:
+  python ukf/test_allocation.py
+  python -m pytest ukf/test_allocation.py
+'''
+
+import os, sys
+# the ukf modules import each other by name, so make them importable from any working directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import tracemalloc
+import numpy as np
+import UKF_algorithm
+import hfunc
+
+
+# calls made before measuring, so that workspaces and numpy's internal caches are in place
+WARMUP = 10
+# calls measured by each test
+STEPS = 1000
+# largest memory (in bytes) traced at any point during one step. numpy's array headers for slices and views
+# and python's frames are traced too, and take a step to about 3.6 KB; a single temporary the size of the
+# sigma point matrix (2*n+1 x n) would go past this limit
+STEP_PEAK_LIMIT = 4096
+
+
+def createFilter():
+    '''
+    createFilter
+        builds a UKFilter on the 1D test EOMs with float arrays, and the inputs for its step
+
+    @returns
+        ukfFilter: UKFilter instance
+        inputs: list of inputs for ukfFilter.step (b field, reaction speeds, old reaction speeds, data)
+    '''
+    n = 7
+    Bfield = np.array([19.42900375, 1.74830615, 49.13746833])
+    speeds = np.zeros(3)
+    data = np.concatenate((Bfield, np.zeros(3)))
+    ukfFilter = UKF_algorithm.UKFilter(UKF_algorithm.createEOMS(), hfunc.hfunc_batch, np.array([1.0, 0, 0, 0, 0, 0, 0]),
+        np.identity(n) * 5e-10, np.identity(n) * 0.05, np.identity(n - 1) * 0.1)
+
+    return ukfFilter, [Bfield, speeds, speeds, data]
+
+
+def arrayFilters():
+    '''
+    arrayFilters
+        tracemalloc filters that keep only numpy array data allocated in UKF_algorithm.py and hfunc.py
+
+    @returns
+        filters: list of tracemalloc.Filter
+    '''
+    return [tracemalloc.Filter(True, module.__file__, domain=np.lib.tracemalloc_domain) for module in (UKF_algorithm, hfunc)]
+
+
+def test_step_retains_no_arrays():
+    '''
+    test_step_retains_no_arrays
+        after warm-up, STEPS calls of UKFilter.step leave no more array memory allocated by the filter than before
+    '''
+    ukfFilter, inputs = createFilter()
+
+    tracemalloc.start()
+    try:
+        for i in range(WARMUP):
+            ukfFilter.step(*inputs)
+
+        before = tracemalloc.take_snapshot().filter_traces(arrayFilters())
+        for i in range(STEPS):
+            ukfFilter.step(*inputs)
+        after = tracemalloc.take_snapshot().filter_traces(arrayFilters())
+    finally:
+        tracemalloc.stop()
+
+    retained = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    assert retained == 0, "UKFilter.step retained {} bytes of arrays over {} calls".format(retained, STEPS)
+
+
+def test_step_peak_memory():
+    '''
+    test_step_peak_memory
+        after warm-up, no call of UKFilter.step holds more than STEP_PEAK_LIMIT bytes at once
+    '''
+    ukfFilter, inputs = createFilter()
+
+    tracemalloc.start()
+    try:
+        for i in range(WARMUP):
+            ukfFilter.step(*inputs)
+
+        peak = 0
+        for i in range(STEPS):
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            ukfFilter.step(*inputs)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+    finally:
+        tracemalloc.stop()
+
+    assert peak <= STEP_PEAK_LIMIT, "UKFilter.step peaked at {} bytes, limit is {}".format(peak, STEP_PEAK_LIMIT)
+
+
+if __name__ == '__main__':
+
+    test_step_retains_no_arrays()
+    test_step_peak_memory()
+    print("UKFilter.step allocates no arrays after warm-up")
@@ -0,0 +1,90 @@
+'''
+test_srukf.py
+
+Long-run checks of the square root UKF (SRUKF): its carried cholesky factor must stay a valid
+upper triangular factor with a positive diagonal for thousands of steps without any repairs.
+Run directly or with pytest:
+  python ukf/test_srukf.py
+  python -m pytest ukf/test_srukf.py
+'''
+
+import os, sys
+# the ukf modules import each other by name, so make them importable from any working directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+import UKF_algorithm
+
+
+# steps of the long run
+STEPS = 3000
+
+
+def createInputs():
+    '''
+    createInputs
+        starting state and noise factors for the SRUKF on the 1D test EOMs, with a fixed b field
+
+    @returns
+        means: starting state (1 x n)
+        sqrtCov, sqrtQ, sqrtR: upper triangular factors of starting, process noise and measurement noise covariance
+        Bfield: b field passed in place of gps data (1 x 3)
+        speeds: reaction wheel speeds (1 x 3)
+    '''
+    n = 7
+    means = np.array([1.0, 0, 0, 0, 0, 0, 0])
+    sqrtCov = UKF_algorithm.choleskyFactor(np.identity(n) * 0.05)
+    sqrtQ = UKF_algorithm.choleskyFactor(np.identity(n) * 5e-10)
+    sqrtR = UKF_algorithm.choleskyFactor(np.identity(n - 1) * 0.1)
+    Bfield = np.array([19.42900375, 1.74830615, 49.13746833])
+    speeds = np.zeros(3)
+
+    return means, sqrtCov, sqrtQ, sqrtR, Bfield, speeds
+
+
+def test_long_run_factor_stays_valid():
+    '''
+    test_long_run_factor_stays_valid
+        runs STEPS steps on noisy measurements and checks the factor after every one
+    '''
+    rng = np.random.default_rng(0)
+    means, sqrtCov, sqrtQ, sqrtR, Bfield, speeds = createInputs()
+
+    for i in range(STEPS):
+        data = np.concatenate((Bfield, np.zeros(3))) + rng.normal(scale=0.3, size=6)
+        means, sqrtCov = UKF_algorithm.SRUKF(means, sqrtCov, sqrtQ, sqrtR, Bfield, speeds, speeds, data)
+
+        assert np.all(np.isfinite(sqrtCov)), "factor is not finite at step {}".format(i)
+        assert np.all(np.tril(sqrtCov, -1) == 0), "factor is not upper triangular at step {}".format(i)
+        assert np.all(np.diag(sqrtCov) > 0), "factor diagonal is not positive at step {}".format(i)
+
+
+def test_failed_downdate_is_rebuilt():
+    '''
+    test_failed_downdate_is_rebuilt
+        if every cholesky downdate fails, SRUKF rebuilds the same factor with QR instead of raising
+    '''
+    means, sqrtCov, sqrtQ, sqrtR, Bfield, speeds = createInputs()
+    data = np.concatenate((Bfield, np.zeros(3))) + 0.3
+
+    expectedMeans, expected = UKF_algorithm.SRUKF(means, sqrtCov, sqrtQ, sqrtR, Bfield, speeds, speeds, data)
+
+    def failingUpdate(factor, x, sign):
+        raise np.linalg.LinAlgError("cholesky downdate made matrix no longer positive definite")
+
+    cholUpdate = UKF_algorithm.cholUpdate
+    UKF_algorithm.cholUpdate = failingUpdate
+    try:
+        rebuiltMeans, rebuilt = UKF_algorithm.SRUKF(means, sqrtCov, sqrtQ, sqrtR, Bfield, speeds, speeds, data)
+    finally:
+        UKF_algorithm.cholUpdate = cholUpdate
+
+    assert np.allclose(rebuiltMeans, expectedMeans)
+    assert np.allclose(np.matmul(rebuilt.T, rebuilt), np.matmul(expected.T, expected), rtol=1e-6, atol=1e-12)
+
+
+if __name__ == '__main__':
+
+    test_long_run_factor_stays_valid()
+    test_failed_downdate_is_rebuilt()
+    print("SRUKF factor stayed valid over {} steps".format(STEPS))